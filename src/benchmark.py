@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+"""Headless benchmarks of the rendering core.
+
+Generates synthetic images and times decoding, pixbuf to cairo
+conversion, preview composition and PDF generation for every
+images-per-page mode. Only printit.renderer and
+the modules below it are used, so there is no dialog, no cups and no lp
+involved. Every case runs in its own interpreter, so peak RSS and cache
+state belong to that case only.
+
+    benchmark.py                  run and compare with the baseline
+    benchmark.py --save           run and store the results as baseline
+    benchmark.py --quick          smaller images, fewer of them
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+
+ROOTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOTDIR, 'printit'))
+BASELINE = os.path.join(ROOTDIR, 'benchmark-baseline.json')
+TOLERANCE = 0.2
+A4 = (210.0, 297.0)
+IMAGES_PER_PAGE = [1, 2, 4, 6, 8]
+FORMATS = ['jpeg', 'png']
+SIZES = [(640, 480), (3000, 2000), (6000, 4000)]
+QUICK_SIZES = [(640, 480), (1600, 1200)]
+NUMBER_OF_IMAGES = 24
+QUICK_NUMBER_OF_IMAGES = 8
+
+
+def get_peak_rss():
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def create_sample(filename, width, height, aformat):
+    """Writes a gradient with some structure, so that it does not
+    compress to nothing like a flat color would"""
+    import cairo
+    from gi.repository import GdkPixbuf
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    context = cairo.Context(surface)
+    gradient = cairo.LinearGradient(0, 0, width, height)
+    gradient.add_color_stop_rgb(0.0, 0.9, 0.3, 0.1)
+    gradient.add_color_stop_rgb(1.0, 0.1, 0.4, 0.9)
+    context.set_source(gradient)
+    context.paint()
+    context.set_source_rgb(1.0, 1.0, 1.0)
+    for i in range(0, width, 37):
+        context.move_to(i, 0)
+        context.line_to(width - i, height)
+    context.stroke()
+    png = filename + '.png'
+    surface.write_to_png(png)
+    if aformat == 'png':
+        os.rename(png, filename)
+        return
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file(png)
+    pixbuf.savev(filename, aformat, [], [])
+    os.remove(png)
+
+
+def create_samples(directory, sizes, number_of_images):
+    samples = {}
+    for aformat in FORMATS:
+        for width, height in sizes:
+            key = '%s-%sx%s' % (aformat, width, height)
+            filename = os.path.join(directory, key + '.' + aformat)
+            create_sample(filename, width, height, aformat)
+            # the same file repeated would only measure the cache and
+            # be deduplicated, so every image of a job is its own copy,
+            # made distinct by padding after the end of the image
+            copies = []
+            for i in range(number_of_images):
+                copy = os.path.join(directory, '%s-%03d.%s' % (key, i,
+                                                               aformat))
+                shutil.copy(filename, copy)
+                with open(copy, 'ab') as f:
+                    f.write(b'\0' * (i + 1))
+                copies.append(copy)
+            samples[key] = copies
+    return samples
+
+
+def run_decode(filenames, images_per_page):
+    from imagecache import create_image_surface_from_file
+    start = time.time()
+    for filename in filenames:
+        create_image_surface_from_file(filename)
+    return {'seconds': time.time() - start, 'images': len(filenames)}
+
+
+def run_convert(filenames, images_per_page):
+    """Times the conversion of decoded pixbufs to cairo surfaces, and the
+    same done by painting with Gdk for reference"""
+    from gi.repository import GdkPixbuf
+    from imagecache import create_image_surface_from_pixbuf,\
+        create_image_surface_with_gdk
+    seconds = 0.0
+    gdk_seconds = 0.0
+    for filename in filenames:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
+        start = time.time()
+        create_image_surface_from_pixbuf(pixbuf)
+        seconds += time.time() - start
+        start = time.time()
+        create_image_surface_with_gdk(pixbuf)
+        gdk_seconds += time.time() - start
+    return {'seconds': seconds, 'gdk_seconds': gdk_seconds,
+            'images': len(filenames)}
+
+
+def run_preview(filenames, images_per_page):
+    from renderer import compose_page
+    start = time.time()
+    pages = 0
+    for first in range(0, len(filenames), images_per_page):
+        compose_page(filenames[first:], images_per_page, A4[0], A4[1],
+                     1.3)
+        pages += 1
+    return {'seconds': time.time() - start, 'images': len(filenames),
+            'pages': pages}
+
+
+def run_pdf(filenames, images_per_page):
+    from renderer import render_pdf
+    output = tempfile.mkstemp(suffix='.pdf')[1]
+    start = time.time()
+    render_pdf(filenames, output, A4[0], A4[1], images_per_page)
+    seconds = time.time() - start
+    size = os.path.getsize(output)
+    os.remove(output)
+    return {'seconds': seconds, 'images': len(filenames),
+            'pages': (len(filenames) + images_per_page - 1) //
+            images_per_page,
+            'pdf_bytes': size}
+
+CASES = {'decode': run_decode, 'convert': run_convert,
+         'preview': run_preview, 'pdf': run_pdf}
+
+
+def run_case(name, filenames, images_per_page, directory):
+    """Runs one case in a new interpreter, with empty caches on disk
+    under directory instead of the user's, and returns its measures"""
+    env = dict(os.environ)
+    env['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='cache_', dir=directory)
+    ans = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--case', name,
+         str(images_per_page)] + filenames, env=env)
+    return json.loads(ans.decode('utf-8').strip().splitlines()[-1])
+
+
+def add_throughput(result):
+    seconds = max(result['seconds'], 1e-9)
+    result['images_per_second'] = result['images'] / seconds
+    if 'pages' in result:
+        result['pages_per_second'] = result['pages'] / seconds
+    return result
+
+
+def run_all(quick=False):
+    directory = tempfile.mkdtemp(prefix='printit_benchmark_')
+    try:
+        if quick:
+            samples = create_samples(directory, QUICK_SIZES,
+                                     QUICK_NUMBER_OF_IMAGES)
+        else:
+            samples = create_samples(directory, SIZES, NUMBER_OF_IMAGES)
+        results = {}
+        for key, filenames in sorted(samples.items()):
+            for name in ['decode', 'convert']:
+                results['%s/%s' % (name, key)] = add_throughput(
+                    run_case(name, filenames, 1, directory))
+            for images_per_page in IMAGES_PER_PAGE:
+                for name in ['preview', 'pdf']:
+                    results['%s/%s/%s-up' % (name, key, images_per_page)] =\
+                        add_throughput(run_case(name, filenames,
+                                                images_per_page, directory))
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def compare(results, baseline):
+    """Cases that got slower, bigger or hungrier than the baseline allows"""
+    regressions = []
+    for case, result in sorted(results.items()):
+        if case not in baseline:
+            continue
+        for measure in ['seconds', 'peak_rss', 'pdf_bytes']:
+            if measure not in result or measure not in baseline[case]:
+                continue
+            if result[measure] > baseline[case][measure] * (1 + TOLERANCE):
+                regressions.append((case, measure, baseline[case][measure],
+                                    result[measure]))
+    return regressions
+
+
+def print_results(results):
+    for case, result in sorted(results.items()):
+        line = '%-40s %8.3f s %8.1f img/s' % (case, result['seconds'],
+                                               result['images_per_second'])
+        if 'pages_per_second' in result:
+            line += ' %7.1f pages/s' % result['pages_per_second']
+        line += ' %7.1f MB RSS' % (result['peak_rss'] / 1048576.0)
+        if 'gdk_seconds' in result:
+            line += ' %5.1fx faster than gdk' % (
+                result['gdk_seconds'] / max(result['seconds'], 1e-9))
+        if 'pdf_bytes' in result:
+            line += ' %9.1f KB PDF' % (result['pdf_bytes'] / 1024.0)
+        print(line)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--case':
+        result = CASES[sys.argv[2]](sys.argv[4:], int(sys.argv[3]))
+        result['peak_rss'] = get_peak_rss()
+        print(json.dumps(result))
+        exit(0)
+    results = run_all('--quick' in sys.argv)
+    print_results(results)
+    if '--save' in sys.argv:
+        with open(BASELINE, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        exit(0)
+    if os.path.exists(BASELINE):
+        with open(BASELINE, 'r') as f:
+            regressions = compare(results, json.load(f))
+        for case, measure, before, after in regressions:
+            print('REGRESSION %s %s: %s -> %s' % (case, measure, before,
+                                                  after))
+        if regressions:
+            exit(1)
+    exit(0)
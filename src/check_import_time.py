@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import sys
+import json
+import subprocess
+
+IMPORT_BUDGET = 0.05
+EXTENSION = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'nautilus-printit.py')
+# modules that must only be loaded when the menu item is activated
+DEFERRED = ['printit.printdialog', 'printit.miniview', 'printit.imagecache',
+            'printit.decoder', 'printit.printers', 'printit.layout',
+            'printit.renderer', 'printit.jobqueue', 'printit.metrics',
+            'printit.thumbnails', 'cairo', 'cups', 'PIL']
+PROBE = '''
+import importlib.util
+import json
+import sys
+import time
+from gi.repository import GObject
+from gi.repository import Nautilus
+sys.path.insert(0, %r)
+start = time.time()
+spec = importlib.util.spec_from_file_location('nautilus_printit', %r)
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+elapsed = time.time() - start
+print(json.dumps({'elapsed': elapsed,
+                  'loaded': [name for name in %r if name in sys.modules]}))
+'''
+
+
+def measure_import_time():
+    """Loads the extension in a fresh interpreter, after the modules
+    Nautilus has already loaded, and returns the time it took and the
+    deferred modules that got loaded anyway"""
+    probe = PROBE % (os.path.dirname(EXTENSION), EXTENSION, DEFERRED)
+    ans = subprocess.check_output([sys.executable, '-c', probe])
+    result = json.loads(ans.decode('utf-8').strip().splitlines()[-1])
+    return result['elapsed'], result['loaded']
+
+if __name__ == '__main__':
+    budget = IMPORT_BUDGET
+    if len(sys.argv) > 1:
+        budget = float(sys.argv[1])
+    elapsed, loaded = measure_import_time()
+    print('Import time: %.1f ms (budget %.1f ms)' % (elapsed * 1000.0,
+                                                     budget * 1000.0))
+    if loaded:
+        print('Loaded at import time: %s' % ', '.join(loaded))
+    if elapsed > budget or loaded:
+        exit(1)
+    exit(0)
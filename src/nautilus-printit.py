@@ -22,22 +22,30 @@
 #
 #
 import os
-import threading
-from urllib import unquote_plus
 from gi.repository import GObject
-from gi.repository import Gtk
 from gi.repository import Nautilus as FileManager
-from printit.comun import _, EXTENSIONS_FROM
-from printit.printdialog import PrintDialog
+# only what is needed to build the menu is imported here, the dialog and
+# the rendering code are imported the first time the menu item is used
+from printit.comun import _, EXTENSIONS_FROM, MIMETYPES_FROM
+
+EXTENSIONS = frozenset(EXTENSIONS_FROM)
+MIMETYPES = frozenset(MIMETYPES_FROM)
+
+
+def is_image(item):
+    if item.get_mime_type() in MIMETYPES:
+        return True
+    return os.path.splitext(item.get_name())[1].lower() in EXTENSIONS
 
 
 def get_files(files_in):
+    # Nautilus already knows what each item is, so there is no need to
+    # stat every file of the selection
     files = []
     for file_in in files_in:
-        print(file_in)
-        file_in = unquote_plus(file_in.get_uri()[7:])
-        if os.path.isfile(file_in):
-            files.append(file_in)
+        if file_in.get_uri_scheme() == 'file' and\
+                not file_in.is_directory() and is_image(file_in):
+            files.append(file_in.get_location().get_path())
     return files
 
 
@@ -48,22 +56,29 @@ class PrintItMenuProvider(GObject.GObject, FileManager.MenuProvider):
     def __init__(self):
         """File Manager crashes if a plugin doesn't implement the __init__
          method"""
-        pass
+        self.last_selection = None
+        self.last_result = False
 
     def all_files_are_images(self, items):
-        for item in items:
-            fileName, fileExtension = os.path.splitext(
-                unquote_plus(item.get_uri()[7:]))
-            if fileExtension.lower() in EXTENSIONS_FROM:
-                return True
-        return False
+        selection = tuple(items)
+        if selection != self.last_selection:
+            self.last_selection = selection
+            self.last_result = any(is_image(item) for item in selection)
+        return self.last_result
 
     def printit(self, menu, selected):
-        files = get_files(selected)
-        printDialog = PrintDialog(_('Print'), files)
+        from gi.repository import Gtk
+        from printit.printdialog import PrintDialog
+        from printit.jobqueue import get_job_queue
+        from printit.metrics import Stages
+        stages = Stages()
+        with stages.stage('selection'):
+            files = get_files(selected)
+        printDialog = PrintDialog(_('Print'), files, stages=stages)
         if printDialog.run() == Gtk.ResponseType.ACCEPT:
             printDialog.hide()
-            printDialog.pprint()
+            # rendering and spooling happen off the Nautilus main loop
+            get_job_queue().put(printDialog.get_job())
         printDialog.destroy()
 
     def get_file_items(self, window, sel_items):
@@ -80,6 +95,9 @@ class PrintItMenuProvider(GObject.GObject, FileManager.MenuProvider):
             return top_menuitem,
         return
 if __name__ == '__main__':
+    import threading
+    from gi.repository import Gtk
+    from printit.printdialog import PrintDialog
     files = ['/home/lorenzo/Escritorio/sample1.jpg',
         '/home/lorenzo/Escritorio/sample2.jpg',
         '/home/lorenzo/Escritorio/sample1.jpg',
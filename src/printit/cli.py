@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import sys
+import glob
+import argparse
+
+from comun import _, APP, PORTRAIT, LANDSCAPE, NUM_THREADS, MEMORY_BUDGET,\
+    OVERSAMPLING, CHUNK_PAGES
+from layout import GRIDS, PAPER_SIZES, get_page_size
+from renderer import render_pdf, parse_resolution
+from metrics import METRICS
+
+
+def expand_files(patterns, files_from=None):
+    """Files matching patterns, plus the ones listed one per line in
+    files_from ('-' reads them from stdin)"""
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches and os.path.isfile(pattern):
+            matches = [pattern]
+        filenames.extend(match for match in matches if os.path.isfile(match))
+    if files_from is not None:
+        if files_from == '-':
+            lines = sys.stdin
+        else:
+            lines = open(files_from, 'r')
+        for line in lines:
+            filename = line.rstrip('\n')
+            if filename and os.path.isfile(filename):
+                filenames.append(filename)
+    return filenames
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog=APP + '-cli',
+        description=_('Print images, several per page, without a dialog'))
+    parser.add_argument('files', nargs='*',
+                        help=_('images or glob patterns'))
+    parser.add_argument('-f', '--files-from', metavar='LIST',
+                        help=_('read more images from LIST, one per line '
+                               '(- for stdin)'))
+    parser.add_argument('-n', '--images-per-page', type=int, default=1,
+                        choices=sorted(GRIDS.keys()))
+    parser.add_argument('-l', '--landscape', action='store_true')
+    parser.add_argument('-s', '--papersize', default='A4',
+                        choices=sorted(PAPER_SIZES.keys()))
+    parser.add_argument('-r', '--resolution',
+                        help=_('printer resolution, like 300dpi, used to '
+                               'downsample the images and sent to the '
+                               'printer'))
+    parser.add_argument('--oversampling', type=float, default=OVERSAMPLING)
+    parser.add_argument('-j', '--threads', type=int, default=NUM_THREADS)
+    parser.add_argument('--memory-budget', type=int,
+                        default=MEMORY_BUDGET // (1024 * 1024),
+                        help=_('MB of decoded images kept in memory, '
+                               '0 to disable streaming'))
+    parser.add_argument('--chunk-pages', type=int, default=CHUNK_PAGES,
+                        help=_('send the job to the printer as separate '
+                               'jobs of this many pages, so printing '
+                               'starts sooner (default 0, a single job)'))
+    destination = parser.add_mutually_exclusive_group(required=True)
+    destination.add_argument('-o', '--output',
+                             help=_('PDF file to write (- for stdout)'))
+    destination.add_argument('-p', '--printer')
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    filenames = expand_files(args.files, args.files_from)
+    if not filenames:
+        parser.error(_('no images to print'))
+    if args.landscape:
+        orientation = LANDSCAPE
+    else:
+        orientation = PORTRAIT
+    width, height = get_page_size(args.papersize, orientation)
+    dpi = -1
+    if args.resolution:
+        dpi = parse_resolution(args.resolution)
+
+    def render(output):
+        render_pdf(filenames, output, width, height, args.images_per_page,
+                   dpi=dpi, oversampling=args.oversampling,
+                   num_threads=args.threads,
+                   memory_budget=args.memory_budget * 1024 * 1024)
+
+    if args.output:
+        METRICS.begin_job()
+        try:
+            if args.output == '-':
+                render(getattr(sys.stdout, 'buffer', sys.stdout))
+            else:
+                render(args.output)
+        finally:
+            METRICS.end_job(args.output)
+    else:
+        from jobqueue import PrintJob
+        PrintJob(filenames, args.printer, args.papersize, orientation,
+                 args.images_per_page, dpi=dpi,
+                 oversampling=args.oversampling, num_threads=args.threads,
+                 memory_budget=args.memory_budget * 1024 * 1024,
+                 chunk_pages=args.chunk_pages,
+                 resolution=args.resolution).run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,8 +25,6 @@ import os
 import locale
 import gettext
 import sys
-from gi.repository import GdkPixbuf
-import collections
 
 __author__ = 'Lorenzo Carbonell <lorenzo.carbonell.cerezo@gmail.com>'
 __copyright__ = 'Copyright (c) 2016 Lorenzo Carbonell'
@@ -53,35 +51,62 @@ else:
     ICONDIR = os.path.normpath(os.path.join(ROOTDIR, '../../data/icons'))
     DEBIANDIR = os.path.normpath(os.path.join(ROOTDIR, '../../debian'))
     CHANGELOG = os.path.join(DEBIANDIR, 'changelog')
-print(CHANGELOG)
+CONFIG_DIR = os.path.join(os.path.expanduser('~'), '.config', APP)
+CONFIG_FILE = os.path.join(CONFIG_DIR, APP + '.conf')
+PREVIEW_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'), APP, 'previews')
 ICON = os.path.join(ICONDIR, 'nautilus-printit.svg')
 
-f = open(CHANGELOG, 'r')
-line = f.readline()
-f.close()
-pos = line.find('(')
-posf = line.find(')', pos)
-VERSION = line[pos + 1:posf].strip()
-if not is_package():
-    VERSION = VERSION + '-src'
+
+def get_version():
+    f = open(CHANGELOG, 'r')
+    line = f.readline()
+    f.close()
+    pos = line.find('(')
+    posf = line.find(')', pos)
+    version = line[pos + 1:posf].strip()
+    if not is_package():
+        version = version + '-src'
+    return version
+
 try:
     current_locale, encoding = locale.getdefaultlocale()
     language = gettext.translation(APP, LANGDIR, [current_locale])
     language.install()
-    print(language)
     if sys.version_info[0] == 3:
         _ = language.gettext
     else:
         _ = language.ugettext
 except Exception as e:
-    print(e)
+    # stdout may be a document, as in nautilus-printit-cli -o -
+    sys.stderr.write('%s\n' % e)
     _ = str
 APPNAME = _(APPNAME)
 
-NUM_THREADS = 4
+try:
+    NUM_THREADS = os.sysconf('SC_NPROCESSORS_ONLN')
+except (AttributeError, ValueError):
+    NUM_THREADS = 4
+IMAGE_CACHE_SIZE = 256 * 1024 * 1024
+IMAGE_SIZES_CACHE_SIZE = 65536
+PREVIEW_CACHE_SIZE = 128 * 1024 * 1024
+PAGES_CACHE_SIZE = 64 * 1024 * 1024
+TILES_CACHE_SIZE = 64 * 1024 * 1024
+TILE_SIZE = 256
+MAX_SCALE = 32.0
+# bytes of decoded images a print holds; prints with a budget use the
+# image cache but do not fill it, 0 goes through the cache unbounded
+MEMORY_BUDGET = 512 * 1024 * 1024
+OVERSAMPLING = 1.5
+CAPABILITIES_TTL = 300
+# pages per cups job, 0 sends the whole job as one; chunks are separate
+# jobs with their own banner and accounting, so they are opt in
+CHUNK_PAGES = 0
 SEPARATOR = u'\u2015' * 10
 RESOLUTION = 1
 MMTOPIXEL = 3.779527559055
+MMTOPT = 72.0 / 25.4
 MMTOPDF = 4
 MMTOPNG = 1169.0 / 842.0
 TOP = -1
@@ -105,25 +130,37 @@ MIMETYPES_FROM = ['image/x-ms-bmp', 'image/gif', 'image/jpeg', 'image/jp2',
                   'image/x-portable-anymap', 'image/x-cmu-raster',
                   'image/tiff', 'image/x-xpixmap']
 
-MIMETYPES_IMAGE = {}
+MIMETYPES_IMAGE = None
+
+
+def get_mimetypes_image():
+    global MIMETYPES_IMAGE
+    if MIMETYPES_IMAGE is not None:
+        return MIMETYPES_IMAGE
+    import collections
+    from gi.repository import GdkPixbuf
+    mimetypes_image = {}
+    all_mime_types = []
+    all_paterns = []
+    for aformat in GdkPixbuf.Pixbuf.get_formats():
+        mime_types = []
+        patterns = []
+        for amimetype in aformat.get_mime_types():
+            mime_types.append(amimetype)
+            all_mime_types.append(amimetype)
+        for extension in aformat.get_extensions():
+            patterns.append('*.' + extension)
+            all_paterns.append('*.' + extension)
+        mimetypes_image[
+            aformat.get_description()] = {'mimetypes': mime_types,
+                                          'patterns': patterns}
+    mimetypes_image[_('ALL')] = {
+        'mimetypes': all_mime_types, 'patterns': all_paterns}
+    MIMETYPES_IMAGE = collections.OrderedDict(
+        sorted(mimetypes_image.items()))
+    return MIMETYPES_IMAGE
 
-all_mime_types = []
-all_paterns = []
-for aformat in GdkPixbuf.Pixbuf.get_formats():
-    mime_types = []
-    patterns = []
-    for amimetype in aformat.get_mime_types():
-        mime_types.append(amimetype)
-        all_mime_types.append(amimetype)
-    for extension in aformat.get_extensions():
-        patterns.append('*.' + extension)
-        all_paterns.append('*.' + extension)
-    MIMETYPES_IMAGE[
-        aformat.get_description()] = {'mimetypes': mime_types,
-                                      'patterns': patterns}
-MIMETYPES_IMAGE[_('ALL')] = {
-    'mimetypes': all_mime_types, 'patterns': all_paterns}
-MIMETYPES_IMAGE = collections.OrderedDict(sorted(MIMETYPES_IMAGE.items()))
 if __name__ == '__main__':
-    print(MIMETYPES_IMAGE)
+    print(get_version())
+    print(get_mimetypes_image())
     exit(0)
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import threading
+
+from comun import NUM_THREADS
+from imagecache import get_image_surface, get_image_size
+
+
+def estimate_image_memory(filename):
+    try:
+        width, height = get_image_size(filename)
+    except Exception:
+        return 0
+    return width * height * 4
+
+
+class DecodePipeline():
+    """Decodes images with a pool of worker threads while the consumer
+    paints. At most prefetch images are decoded ahead of the consumer and
+    they are always returned in the same order as filenames.
+
+    With a memory_budget (in bytes) decoded images are accounted until the
+    consumer calls release, and workers wait for memory to be released
+    before decoding more. The image the consumer needs next is always
+    decoded, even when it does not fit in the budget"""
+
+    def __init__(self, filenames, loader=get_image_surface,
+                 num_threads=NUM_THREADS, prefetch=-1, memory_budget=-1):
+        self.filenames = filenames
+        self.loader = loader
+        self.num_threads = max(1, num_threads)
+        if prefetch < 1:
+            prefetch = 2 * self.num_threads
+        self.slots = threading.Semaphore(prefetch)
+        self.condition = threading.Condition()
+        self.results = {}
+        self.next_index = 0
+        self.stopped = False
+        self.workers = []
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.memory = {}
+        self.next_granted = 0
+        self.consumed = 0
+        self.released = 0
+
+    def start(self):
+        for i in range(min(self.num_threads, len(self.filenames))):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.results.clear()
+            self.condition.notify_all()
+        self.slots.release()
+
+    def release(self, indexes=None):
+        """Frees the budget of the images at indexes, or of every image
+        handed to the consumer so far"""
+        with self.condition:
+            if indexes is None:
+                indexes = range(self.released, self.consumed)
+                self.released = self.consumed
+            for index in indexes:
+                self.memory_used -= self.memory.pop(index, 0)
+            self.condition.notify_all()
+
+    def reserve(self, index):
+        size = estimate_image_memory(self.filenames[index])
+        with self.condition:
+            # memory is granted in order so a later image can never take
+            # the budget the consumer is waiting on
+            while not self.stopped and (
+                    index != self.next_granted or
+                    (index != self.consumed and
+                     self.memory_used + size > self.memory_budget)):
+                self.condition.wait()
+            if self.stopped:
+                return False
+            self.memory_used += size
+            self.memory[index] = size
+            self.next_granted += 1
+            self.condition.notify_all()
+        return True
+
+    def work(self):
+        while True:
+            self.slots.acquire()
+            with self.condition:
+                if self.stopped or self.next_index >= len(self.filenames):
+                    # wake up the next waiting worker so it can finish too
+                    self.slots.release()
+                    return
+                index = self.next_index
+                self.next_index += 1
+            if self.memory_budget > 0 and not self.reserve(index):
+                self.slots.release()
+                return
+            try:
+                result = (self.loader(self.filenames[index]), None)
+            except Exception as e:
+                result = (None, e)
+            with self.condition:
+                if not self.stopped:
+                    self.results[index] = result
+                    self.condition.notify_all()
+
+    def __iter__(self):
+        self.start()
+        try:
+            for index in range(len(self.filenames)):
+                with self.condition:
+                    while index not in self.results:
+                        self.condition.wait()
+                    image, error = self.results.pop(index)
+                    self.consumed = index + 1
+                    self.condition.notify_all()
+                self.slots.release()
+                if error is not None:
+                    raise error
+                yield image
+        finally:
+            self.close()
@@ -0,0 +1,410 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import io
+import sys
+import math
+import hashlib
+import threading
+import collections
+from gi.repository import GdkPixbuf
+import cairo
+
+from comun import IMAGE_CACHE_SIZE, IMAGE_SIZES_CACHE_SIZE
+from thumbnails import load_preview_pixbuf
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+JP2_MAGIC = b'\x00\x00\x00\x0cjP  \r\n\x87\n'
+HASH_CHUNK_SIZE = 1024 * 1024
+JPEG_QUALITY = 90
+# PIL raw modes matching the memory layout of cairo RGB24 and ARGB32
+if sys.byteorder == 'little':
+    RGB24_RAWMODE = 'BGRX'
+    ARGB32_RAWMODE = 'BGRa'
+else:
+    RGB24_RAWMODE = 'XRGB'
+    ARGB32_RAWMODE = 'aRGB'
+
+
+def read_image_size(filename):
+    """Reads the size of an image from its header, without decoding it"""
+    aformat, width, height = GdkPixbuf.Pixbuf.get_file_info(filename)
+    if aformat is None:
+        from PIL import Image
+        width, height = Image.open(filename).size
+    return width, height
+
+
+def get_image_size(filename):
+    key = (filename, os.path.getmtime(filename))
+    size = IMAGE_SIZES.get(key)
+    if size is None:
+        size = read_image_size(filename)
+        IMAGE_SIZES.put(key, size)
+    return size
+
+
+def probe_images(filenames):
+    return [get_image_size(filename) for filename in filenames]
+
+
+def create_image_surface_from_file(filename, width=-1, height=-1):
+    if width > 0 and height > 0:
+        # decode at the requested size: the jpeg loader scales while
+        # decoding (DCT scaling), so the full image is never in memory
+        image_width, image_height = get_image_size(filename)
+        if image_width > width or image_height > height:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                filename, width, height)
+            surface = create_image_surface_from_pixbuf(pixbuf)
+            return attach_downsampled_data(surface, pixbuf, filename)
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
+    surface = create_image_surface_from_pixbuf(pixbuf)
+    return attach_source_data(surface, filename)
+
+
+def create_preview_surface(filename, width, height):
+    """Surface of filename scaled to fit in width x height, taken from the
+    thumbnail caches on disk when possible"""
+    image_width, image_height = get_image_size(filename)
+    return create_image_surface_from_pixbuf(load_preview_pixbuf(
+        filename, width, height, image_width, image_height))
+
+
+def create_pyramid_surface(filename, width, height):
+    """Surface of filename scaled to fit in width x height, for the screen
+    only, so without the original stream attached"""
+    image_width, image_height = get_image_size(filename)
+    if image_width > width or image_height > height:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
+            filename, width, height)
+    else:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
+    return create_image_surface_from_pixbuf(pixbuf)
+
+
+def get_source_mime_type(filename):
+    """cairo mime type of a JPEG or JPEG 2000 file, None for others"""
+    with open(filename, 'rb') as f:
+        magic = f.read(len(JP2_MAGIC))
+    if magic.startswith(JPEG_MAGIC):
+        return cairo.MIME_TYPE_JPEG
+    if magic == JP2_MAGIC:
+        return cairo.MIME_TYPE_JP2
+    return None
+
+
+def attach_source_data(surface, filename):
+    """Attaches the original JPEG or JPEG 2000 stream to a full size
+    surface, so the PDF backend embeds it instead of the decoded pixels"""
+    if not hasattr(surface, 'set_mime_data'):
+        return surface
+    mime_type = get_source_mime_type(filename)
+    if mime_type is None:
+        return surface
+    with open(filename, 'rb') as f:
+        surface.set_mime_data(mime_type, f.read())
+    return surface
+
+
+def attach_downsampled_data(surface, pixbuf, filename):
+    """Attaches a compressed stream to a surface downsampled from a JPEG
+    or JPEG 2000 file, so the PDF backend does not embed its pixels
+    flate compressed: the pixels encoded again as JPEG, or else the
+    original stream when it is smaller than the pixels"""
+    if not hasattr(surface, 'set_mime_data'):
+        return surface
+    mime_type = get_source_mime_type(filename)
+    if mime_type is None:
+        return surface
+    size = os.path.getsize(filename)
+    data = None
+    if mime_type == cairo.MIME_TYPE_JPEG:
+        data = encode_jpeg(pixbuf)
+    if data is not None and len(data) < size:
+        surface.set_mime_data(cairo.MIME_TYPE_JPEG, data)
+    elif size < pixbuf.get_width() * pixbuf.get_height() *\
+            pixbuf.get_n_channels():
+        attach_source_data(surface, filename)
+    return surface
+
+
+def encode_jpeg(pixbuf, quality=JPEG_QUALITY):
+    """pixbuf as a JPEG stream, or None when it has alpha or PIL is
+    missing"""
+    image = get_pixbuf_image(pixbuf)
+    if image is None or image.mode != 'RGB':
+        return None
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality)
+    return output.getvalue()
+
+
+def get_pixbuf_image(pixbuf):
+    """PIL image sharing the layout of an 8 bit RGB or RGBA pixbuf, None
+    when PIL is missing or the pixbuf is laid out otherwise"""
+    mode = 'RGBA' if pixbuf.get_has_alpha() else 'RGB'
+    if pixbuf.get_bits_per_sample() != 8 or\
+            pixbuf.get_n_channels() != len(mode):
+        return None
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    rowstride = pixbuf.get_rowstride()
+    try:
+        pixels = pixbuf.read_pixel_bytes().get_data()
+    except AttributeError:
+        pixels = pixbuf.get_pixels()
+    if len(pixels) < rowstride * height:
+        # the last row of a pixbuf is not padded to the rowstride
+        pixels = bytes(pixels) + b'\0' * (rowstride * height - len(pixels))
+    return Image.frombuffer(mode, (width, height), pixels, 'raw', mode,
+                            rowstride, 1)
+
+
+def create_image_surface_from_pixbuf(pixbuf):
+    """Copies the pixels of pixbuf to a new cairo surface, RGB24 when it
+    has no alpha. PIL swizzles (and premultiplies) them in a single pass,
+    without painting; when it can not, Gdk paints the pixbuf"""
+    image = get_pixbuf_image(pixbuf)
+    if image is None:
+        return create_image_surface_with_gdk(pixbuf)
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    try:
+        if image.mode == 'RGBA':
+            aformat = cairo.FORMAT_ARGB32
+            data = image.convert('RGBa').tobytes('raw', ARGB32_RAWMODE)
+        else:
+            aformat = cairo.FORMAT_RGB24
+            data = image.tobytes('raw', RGB24_RAWMODE)
+    except ValueError:
+        return create_image_surface_with_gdk(pixbuf)
+    return cairo.ImageSurface.create_for_data(
+        bytearray(data), aformat, width, height, width * 4)
+
+
+def create_image_surface_with_gdk(pixbuf):
+    # not imported at module level so the cli does not load libgdk
+    from gi.repository import Gdk
+    surface = cairo.ImageSurface(
+        cairo.FORMAT_ARGB32, pixbuf.get_width(), pixbuf.get_height())
+    context = cairo.Context(surface)
+    Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
+    context.paint()
+    return surface
+
+
+def get_file_key(filename):
+    stat = os.stat(filename)
+    return (os.path.realpath(filename), stat.st_mtime, stat.st_size)
+
+
+def get_content_key(filename):
+    """SHA-1 of the content of filename, cached by path, modification
+    time and size"""
+    key = get_file_key(filename)
+    digest = CONTENT_KEYS.get(key)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+        CONTENT_KEYS.put(key, digest)
+    return digest
+
+
+def deduplicate(filenames):
+    """Returns the distinct images in filenames, in order of first use,
+    and for every filename the index of its image in that list. Files
+    are the same image when they have the same path, modification time
+    and size, or else the same content. Only files sharing a size with
+    another one are read to compare their content"""
+    file_keys = [get_file_key(filename) for filename in filenames]
+    sizes = collections.Counter(key[2] for key in set(file_keys))
+    images = []
+    indexes = []
+    seen = {}
+    for filename, key in zip(filenames, file_keys):
+        if sizes[key[2]] > 1:
+            key = get_content_key(filename)
+        if key not in seen:
+            seen[key] = len(images)
+            images.append(filename)
+        indexes.append(seen[key])
+    return images, indexes
+
+
+def set_unique_id(surface, filename):
+    """Tags surface so the PDF backend embeds a single image for every
+    surface decoded from the same file at the same size"""
+    if not hasattr(cairo, 'MIME_TYPE_UNIQUE_ID'):
+        return surface
+    unique_id = '%s-%s-%s-%sx%s' % (get_file_key(filename) + (
+        surface.get_width(), surface.get_height()))
+    surface.set_mime_data(cairo.MIME_TYPE_UNIQUE_ID,
+                          unique_id.encode('utf-8'))
+    return surface
+
+
+def get_surface_size(surface):
+    return surface.get_stride() * surface.get_height()
+
+
+class LRUCache():
+    """Thread safe least recently used cache bounded by the sum of the
+    sizes of its values, as measured by sizeof"""
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        if sizeof is None:
+            sizeof = lambda value: 1
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.items:
+                item = self.items.pop(key)
+                self.items[key] = item
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            self.remove(key)
+            if size > self.max_size:
+                return
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, oldsize) = self.items.popitem(last=False)
+                self.size -= oldsize
+                self.evictions += 1
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {'items': len(self.items),
+                    'size': self.size,
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class ImageCache(LRUCache):
+    """Decoded cairo surfaces keyed by path, modification time and the
+    size they were decoded for (-1, -1 means full size), and the loader
+    that made them, as previews may come from a thumbnail"""
+
+    def __init__(self, max_size=IMAGE_CACHE_SIZE):
+        LRUCache.__init__(self, max_size, get_surface_size)
+
+    def get_surface(self, filename, width=-1, height=-1,
+                    loader=create_image_surface_from_file, store=True):
+        """Cached surface, or a new one that is cached only with store"""
+        key = (filename, os.path.getmtime(filename), width, height,
+               loader.__name__)
+        surface = self.get(key)
+        if surface is None:
+            surface = loader(filename, width, height)
+            if store:
+                self.put(key, surface)
+        return surface
+
+IMAGE_CACHE = ImageCache()
+IMAGE_SIZES = LRUCache(IMAGE_SIZES_CACHE_SIZE)
+CONTENT_KEYS = LRUCache(IMAGE_SIZES_CACHE_SIZE)
+
+
+def get_image_surface(filename, width=-1, height=-1):
+    return IMAGE_CACHE.get_surface(filename, width, height)
+
+
+def get_streamed_surface(filename, width=-1, height=-1):
+    """Surface from the cache when it is already there, else decoded and
+    left out of it, so it is freed as soon as it has been used"""
+    return IMAGE_CACHE.get_surface(filename, width, height, store=False)
+
+
+def get_preview_surface(filename, width, height):
+    return IMAGE_CACHE.get_surface(filename, width, height,
+                                   create_preview_surface)
+
+
+def get_pyramid_level(image_width, image_height, width, height):
+    """Number of times an image can be halved and still have the pixels
+    to be painted in width x height. Levels over a quarter of the image
+    cache are never used, so a level stays cached for every tile painted
+    from it"""
+    level = 0
+    while image_width >> (level + 1) >= width and\
+            image_height >> (level + 1) >= height:
+        level += 1
+    while (image_width >> level) * (image_height >> level) * 4 >\
+            IMAGE_CACHE_SIZE // 4:
+        level += 1
+    return level
+
+
+def get_pyramid_surface(filename, width, height):
+    """Surface of filename at the smallest power of two reduction that
+    can be painted in width x height, so zooming in steps reuses the
+    decoded levels"""
+    image_width, image_height = get_image_size(filename)
+    level = get_pyramid_level(image_width, image_height, width, height)
+    return IMAGE_CACHE.get_surface(
+        filename,
+        int(math.ceil(image_width / 2.0 ** level)),
+        int(math.ceil(image_height / 2.0 ** level)),
+        create_pyramid_surface)
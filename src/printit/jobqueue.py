@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from comun import _, APPNAME, ICON, NUM_THREADS, MEMORY_BUDGET,\
+    OVERSAMPLING, CHUNK_PAGES
+from layout import get_page_size
+from metrics import METRICS
+from printers import print_stream, get_print_options
+from renderer import render_pdf
+
+
+def notify(summary, body=''):
+    try:
+        import gi
+        gi.require_version('Notify', '0.7')
+        from gi.repository import Notify
+    except (ImportError, ValueError):
+        print(summary, body)
+        return
+    if not Notify.is_initted():
+        Notify.init(APPNAME)
+    Notify.Notification.new(summary, body, ICON).show()
+
+
+class PrintJob():
+    """Everything needed to render and submit a job, taken from the dialog
+    so it can run once the dialog is gone"""
+
+    def __init__(self, filenames, printer, papersize, orientation,
+                 images_per_page, dpi=-1, oversampling=OVERSAMPLING,
+                 num_threads=NUM_THREADS, memory_budget=MEMORY_BUDGET,
+                 chunk_pages=CHUNK_PAGES, resolution=None, stages=None):
+        self.filenames = list(filenames)
+        self.printer = printer
+        self.papersize = papersize
+        self.orientation = orientation
+        self.images_per_page = images_per_page
+        self.dpi = dpi
+        self.oversampling = oversampling
+        self.num_threads = num_threads
+        self.memory_budget = memory_budget
+        self.chunk_pages = chunk_pages
+        # the ppd choice, like 600dpi, sent to cups with the job
+        self.resolution = resolution
+        # what was measured before the job, like the selection
+        self.stages = stages
+
+    def get_title(self):
+        if len(self.filenames) == 1:
+            return os.path.basename(self.filenames[0])
+        return _('%s images') % len(self.filenames)
+
+    def get_chunks(self):
+        """Filenames split in chunks of chunk_pages whole pages"""
+        if self.chunk_pages > 0:
+            size = self.chunk_pages * self.images_per_page
+        else:
+            size = max(1, len(self.filenames))
+        return [self.filenames[first:first + size]
+                for first in range(0, len(self.filenames), size)]
+
+    def run(self):
+        """Submits the job, or with chunk_pages every chunk as a job of
+        its own as soon as it is rendered, so the printer starts with the
+        first one while the next ones render. Jobs are created in order
+        on the same queue, so CUPS prints them in order"""
+        METRICS.begin_job(self.stages)
+        try:
+            return self.submit()
+        finally:
+            METRICS.end_job(self.get_title())
+
+    def submit(self):
+        width, height = get_page_size(self.papersize, self.orientation)
+        options = get_print_options(self.papersize, self.orientation,
+                                    self.resolution)
+        chunks = self.get_chunks()
+        job_ids = []
+        for number, filenames in enumerate(chunks):
+
+            def render(output):
+                render_pdf(filenames, output, width, height,
+                           self.images_per_page, dpi=self.dpi,
+                           oversampling=self.oversampling,
+                           num_threads=self.num_threads,
+                           memory_budget=self.memory_budget)
+
+            title = self.get_title()
+            if len(chunks) > 1:
+                title = '%s (%s/%s)' % (title, number + 1, len(chunks))
+            job_ids.append(print_stream(self.printer, title, options,
+                                        render))
+        return job_ids
+
+
+class JobQueue():
+    """Runs print jobs one after another, in the order they were put, on
+    a worker thread of its own, and notifies when each one finishes"""
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def put(self, job):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.work)
+                self.worker.daemon = True
+                self.worker.start()
+        self.jobs.put(job)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                job.run()
+            except Exception as e:
+                self.on_job_finished(job, e)
+            else:
+                self.on_job_finished(job, None)
+            finally:
+                self.jobs.task_done()
+
+    def on_job_finished(self, job, error):
+        if error is None:
+            notify(_('Sent to %s') % job.printer, job.get_title())
+        else:
+            notify(_('Printing %s failed') % job.get_title(), str(error))
+
+JOB_QUEUE = JobQueue()
+
+
+def get_job_queue():
+    return JOB_QUEUE
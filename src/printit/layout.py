@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import math
+
+from comun import PORTRAIT, LANDSCAPE
+
+GRIDS = {1: (1, 1), 2: (2, 1), 4: (2, 2), 6: (3, 2), 8: (4, 2),
+         9: (3, 3), 12: (4, 3), 16: (4, 4), 32: (8, 4), 64: (8, 8)}
+
+
+class Page():
+    def __init__(self, width=-1, height=-1, orientation=PORTRAIT):
+        self.width = width
+        self.height = height
+        self.orientation = orientation
+
+    def get_width(self):
+        return self.width
+
+    def set_width(self, width):
+        self.width = width
+
+    def get_height(self):
+        return self.height
+
+    def set_height(self, height):
+        self.height = height
+
+    def get_size(self):
+        return self.width, self.height
+
+A0 = Page(1189.0, 841.0, LANDSCAPE)
+A1 = Page(841.0, 594.0, LANDSCAPE)
+A2 = Page(594.0, 420.0, LANDSCAPE)
+A3 = Page(420.0, 297.0, LANDSCAPE)
+A4 = Page(297.0, 210.0, LANDSCAPE)
+A5 = Page(210.0, 148.0, LANDSCAPE)
+A6 = Page(148.0, 105.0, LANDSCAPE)
+A7 = Page(105.0, 74.0, LANDSCAPE)
+A8 = Page(74.0, 52.0, LANDSCAPE)
+LETTER = Page(279.0, 216.0, LANDSCAPE)
+FOLIO = Page(330.0, 216.0, LANDSCAPE)
+LEGAL = Page(356.0, 216.0, LANDSCAPE)
+TABLOID = Page(432.0, 279.0, LANDSCAPE)
+PAPER_SIZES = {'A0': A0, 'A1': A1, 'A2': A2, 'A3': A3, 'A4': A4, 'A5': A5,
+               'A6': A6, 'A7': A7, 'A8': A8, 'Letter': LETTER,
+               'Folio': FOLIO, 'Legal': LEGAL, 'Tabloid': TABLOID}
+
+
+def get_page_size(papersize, orientation):
+    """Width and height in mm of a named paper size"""
+    width, height = PAPER_SIZES[papersize].get_size()
+    if orientation == PORTRAIT:
+        return height, width
+    return width, height
+
+
+def get_grid(images_per_page):
+    """Columns and rows used to place images_per_page images on a page"""
+    if images_per_page in GRIDS:
+        return GRIDS[images_per_page]
+    columns = int(math.ceil(math.sqrt(images_per_page)))
+    rows = int(math.ceil(images_per_page / float(columns)))
+    return columns, rows
+
+
+def paint_image(context, image, x, y, width, height):
+    context.save()
+    context.translate(x, y)
+    context.scale(float(width) / image.get_width(),
+                  float(height) / image.get_height())
+    context.set_source_surface(image)
+    context.paint()
+    context.restore()
+
+
+class Layout():
+    """Splits a width x height page in a grid of equal cells, filled by
+    rows, and fits images in them keeping their aspect ratio. Units are
+    whatever the page size is given in"""
+
+    def __init__(self, width, height, columns, rows):
+        self.width = float(width)
+        self.height = float(height)
+        self.columns = columns
+        self.rows = rows
+        self.images_per_page = columns * rows
+        self.cell_width = self.width / columns
+        self.cell_height = self.height / rows
+        self.cells = [(column * self.cell_width, row * self.cell_height)
+                      for row in range(rows) for column in range(columns)]
+
+    def get_page(self, index):
+        return index // self.images_per_page
+
+    def is_last_in_page(self, index):
+        return index % self.images_per_page == self.images_per_page - 1
+
+    def count_pages(self, number_of_images):
+        return (number_of_images + self.images_per_page - 1) //\
+            self.images_per_page
+
+    def get_cell(self, index):
+        x, y = self.cells[index % self.images_per_page]
+        return x, y, self.cell_width, self.cell_height
+
+    def place(self, sizes):
+        """Rectangles for a whole job, from the width, height of each
+        image"""
+        return [self.fit(index, width, height)
+                for index, (width, height) in enumerate(sizes)]
+
+    def fit(self, index, image_width, image_height):
+        """Rectangle x, y, width, height where the index-th image is
+        painted"""
+        x, y = self.cells[index % self.images_per_page]
+        scale = min(self.cell_width / image_width,
+                    self.cell_height / image_height)
+        width = image_width * scale
+        height = image_height * scale
+        return (x + (self.cell_width - width) / 2.0,
+                y + (self.cell_height - height) / 2.0,
+                width, height)
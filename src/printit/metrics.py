@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import json
+import time
+import random
+import threading
+import contextlib
+
+from comun import APP
+
+
+class Stages():
+    """Durations of stages measured before there is a job to record them
+    with, like the selection or the printer queries of the dialog. The
+    job adds them to its metrics when it begins"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.time() - start)
+
+    def add_stage(self, name, seconds, calls=1):
+        with self.lock:
+            total_calls, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (total_calls + calls, total + seconds)
+
+    def items(self):
+        with self.lock:
+            return list(self.stages.items())
+
+
+class Metrics(Stages):
+    """Durations of the stages of a print job plus counters like bytes or
+    pixels, written when the job ends.
+
+    Off unless PRINTIT_METRICS names a file: a .prom file gets totals in
+    the Prometheus text format, anything else gets a JSON line per job.
+    PRINTIT_METRICS_SAMPLE (0 to 1) records only that fraction of jobs.
+    Stages of concurrent workers add up and nested stages overlap. Only
+    one job is recorded at a time, as the job queue runs them one after
+    another, and nothing is recorded between jobs"""
+
+    def __init__(self, filename=None, sample=1.0):
+        Stages.__init__(self)
+        self.filename = filename
+        self.sample = sample
+        self.enabled = filename is not None
+        self.recording = False
+        self.counters = {}
+        self.totals_stages = {}
+        self.totals_counters = {}
+        self.jobs = 0
+
+    def begin_job(self, stages=None):
+        """Starts recording a job, with the stages measured before it"""
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.recording = self.enabled and\
+                random.random() < self.sample
+        if self.recording and stages is not None:
+            for name, (calls, seconds) in stages.items():
+                self.add_stage(name, seconds, calls)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.recording:
+            yield
+            return
+        with Stages.stage(self, name):
+            yield
+
+    def count(self, name, value=1):
+        if not self.recording:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def end_job(self, job=''):
+        with self.lock:
+            stages, self.stages = self.stages, {}
+            counters, self.counters = self.counters, {}
+            recording = self.recording
+            self.recording = False
+            if not recording:
+                return
+            self.jobs += 1
+            for name, (calls, seconds) in stages.items():
+                total_calls, total_seconds = self.totals_stages.get(
+                    name, (0, 0.0))
+                self.totals_stages[name] = (total_calls + calls,
+                                            total_seconds + seconds)
+            for name, value in counters.items():
+                self.totals_counters[name] = self.totals_counters.get(
+                    name, 0) + value
+            try:
+                if self.filename.endswith('.prom'):
+                    self.write_prometheus()
+                else:
+                    self.write_json(job, stages, counters)
+            except (IOError, OSError):
+                pass
+
+    def write_json(self, job, stages, counters):
+        record = {'time': time.time(),
+                  'job': job,
+                  'stages': dict((name, {'calls': calls, 'seconds': seconds})
+                                 for name, (calls, seconds)
+                                 in stages.items()),
+                  'counters': counters}
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def write_prometheus(self):
+        prefix = APP.replace('-', '_')
+        lines = ['# TYPE %s_jobs_total counter' % prefix,
+                 '%s_jobs_total %s' % (prefix, self.jobs),
+                 '# TYPE %s_stage_seconds_total counter' % prefix]
+        for name, (calls, seconds) in sorted(self.totals_stages.items()):
+            lines.append('%s_stage_seconds_total{stage="%s"} %f' % (
+                prefix, name, seconds))
+        lines.append('# TYPE %s_stage_calls_total counter' % prefix)
+        for name, (calls, seconds) in sorted(self.totals_stages.items()):
+            lines.append('%s_stage_calls_total{stage="%s"} %s' % (
+                prefix, name, calls))
+        for name, value in sorted(self.totals_counters.items()):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total %s' % (prefix, name, value))
+        # written aside and renamed, so collectors never read half a file
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(temp, self.filename)
+
+
+def create_metrics():
+    try:
+        sample = float(os.environ.get('PRINTIT_METRICS_SAMPLE', '1'))
+    except ValueError:
+        sample = 1.0
+    return Metrics(os.environ.get('PRINTIT_METRICS') or None, sample)
+
+METRICS = create_metrics()
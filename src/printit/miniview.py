@@ -23,62 +23,18 @@
 #
 from gi.repository import Gtk
 from gi.repository import Gdk
-from gi.repository import GdkPixbuf
-import cairo
+from gi.repository import GLib
 import math
+import threading
 
 from comun import RESOLUTION, MMTOPIXEL, TOP, MIDLE, BOTTOM,\
-    LEFT, CENTER, RIGHT, PORTRAIT, LANDSCAPE
-
-
-def create_image_surface_from_file(filename):
-    pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
-    return create_image_surface_from_pixbuf(pixbuf)
-
-
-def create_image_surface_from_pixbuf(pixbuf):
-    surface = cairo.ImageSurface(
-        cairo.FORMAT_ARGB32, pixbuf.get_width(), pixbuf.get_height())
-    context = cairo.Context(surface)
-    Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
-    context.paint()
-    return surface
-
-
-class Page():
-    def __init__(self, width=-1, height=-1, orientation=PORTRAIT):
-        self.width = width
-        self.height = height
-        self.orientation = orientation
-
-    def get_width(self):
-        return self.width
-
-    def set_width(self, width):
-        self.width = width
-
-    def get_height(self):
-        return self.height
-
-    def set_height(self, height):
-        self.height = height
-
-    def get_size(self):
-        return self.width, self.height
-
-A0 = Page(1189.0, 841.0, LANDSCAPE)
-A1 = Page(841.0, 594.0, LANDSCAPE)
-A2 = Page(594.0, 420.0, LANDSCAPE)
-A3 = Page(420.0, 297.0, LANDSCAPE)
-A4 = Page(297.0, 210.0, LANDSCAPE)
-A5 = Page(210.0, 148.0, LANDSCAPE)
-A6 = Page(148.0, 105.0, LANDSCAPE)
-A7 = Page(105.0, 74.0, LANDSCAPE)
-A8 = Page(74.0, 52.0, LANDSCAPE)
-LETTER = Page(279.0, 216.0, LANDSCAPE)
-FOLIO = Page(330.0, 216.0, LANDSCAPE)
-LEGAL = Page(356.0, 216.0, LANDSCAPE)
-TABLOID = Page(432.0, 279.0, LANDSCAPE)
+    LEFT, CENTER, RIGHT, PORTRAIT, LANDSCAPE, PAGES_CACHE_SIZE,\
+    TILES_CACHE_SIZE, TILE_SIZE, MAX_SCALE
+from imagecache import get_surface_size, LRUCache
+from renderer import compose_page, compose_tile
+# the pages moved to layout, they are still imported from here
+from layout import Page, A0, A1, A2, A3, A4, A5, A6, A7, A8, LETTER,\
+    FOLIO, LEGAL, TABLOID
 
 
 class MiniView(Gtk.DrawingArea):
@@ -90,7 +46,16 @@ class MiniView(Gtk.DrawingArea):
                         Gdk.EventMask.BUTTON_RELEASE_MASK)
         self.height = height
         self.width = width
-        self.image_surface = None
+        # composed pages of the current generation, by page number
+        self.pages = LRUCache(PAGES_CACHE_SIZE, get_surface_size)
+        self.page_number = 0
+        # pieces of the zoomed page, by page number, scale and position
+        self.tiles = LRUCache(TILES_CACHE_SIZE, get_surface_size)
+        self.tiles_lock = threading.Lock()
+        self.tiles_wanted = []
+        self.tiles_rendering = set()
+        self.tiles_worker = False
+        self.scale = 1.0
         self.margin = margin
         self.border = border
         self.page = None
@@ -102,170 +67,19 @@ class MiniView(Gtk.DrawingArea):
         self.margin_height = -1
         self.images = []
         self.images_per_page = 1
+        self.generation = 0
+        self.rendering = set()
         self.connect('draw', self.on_expose, None)
         self.set_size_request(self.width, self.height)
 
     def on_expose(self, widget, cr, data):
+        image_surface = None
         if self.page:
-            if self.orientation == LANDSCAPE:
-                zw = (self.width - 2.0 * self.margin) / self.or_width
-                zh = (self.height - 2.0 * self.margin) / self.or_height
-                if zw < zh:
-                    self.zoom = zw
-                else:
-                    self.zoom = zh
-                self.page_width = self.or_width * self.zoom
-                self.page_height = self.or_height * self.zoom
-                self.margin_width = (self.width - self.page_width) / 2.0
-                self.margin_height = (self.height - self.page_height) / 2.0
-            else:
-                zw = (self.width - 2.0 * self.margin) / self.or_height
-                zh = (self.height - 2.0 * self.margin) / self.or_width
-                if zw < zh:
-                    self.zoom = zw
-                else:
-                    self.zoom = zh
-                self.page_width = self.or_height * self.zoom
-                self.page_height = self.or_width * self.zoom
-                self.margin_width = (self.width - self.page_width) / 2.0
-                self.margin_height = (self.height - self.page_height) / 2.0
-            self.image_surface = cairo.ImageSurface(
-                cairo.FORMAT_RGB24,
-                int(self.page_width),
-                int(self.page_height))
-            context = cairo.Context(self.image_surface)
-            context.save()
-            context.set_source_rgba(1.0, 1.0, 1.0, 1.0)
-            context.paint()
-            mtr = cairo.Matrix()
-            if self.orientation == LANDSCAPE:
-                mtr.rotate(math.pi / 2.0)
-            mtr.scale(self.zoom * RESOLUTION, self.zoom * RESOLUTION)
-            context.transform(mtr)
-            if self.orientation == PORTRAIT:
-                context.translate(
-                    0.0, -self.page_width / self.zoom / RESOLUTION)
-            elif self.orientation == LANDSCAPE:
-                context.translate(-self.page_width / self.zoom /
-                                  RESOLUTION, -self.page_height / self.zoom /
-                                  RESOLUTION)
-            context.restore()
-            if len(self.images) > 0:
-                if self.orientation == LANDSCAPE:
-                    main_width = self.or_width
-                    main_height = self.or_height
-                else:
-                    main_width = self.or_height
-                    main_height = self.or_width
-                if self.images_per_page == 1:
-                    image = create_image_surface_from_file(self.images[0])
-                    width = image.get_width() / MMTOPIXEL
-                    height = image.get_height() / MMTOPIXEL
-                    zw = width / main_width
-                    zh = height / main_height
-                    if zw > zh:
-                        z = zw
-                    else:
-                        z = zh
-                    x = abs(width / z - main_width) / 2.0
-                    y = abs(height / z - main_height) / 2.0
-                    context.save()
-                    context.translate(x * self.zoom, y * self.zoom)
-                    context.scale(self.zoom / MMTOPIXEL / z,
-                                  self.zoom / MMTOPIXEL / z)
-                    context.set_source_surface(image)
-                    context.paint()
-                    context.restore()
-                elif self.images_per_page == 2 and len(self.images) >= 2:
-                    for i in range(0, 2):
-                        image = create_image_surface_from_file(self.images[i])
-                        width = image.get_width() / MMTOPIXEL
-                        height = image.get_height() / MMTOPIXEL
-                        zw = width / (main_width / 2.0)
-                        zh = height / main_height
-                        if zw > zh:
-                            z = zw
-                        else:
-                            z = zh
-                        x = float(i) * main_width / 2.0 +\
-                            abs(width / z - main_width / 2.0) / 2.0
-                        y = abs(height / z - main_height) / 2.0
-                        context.save()
-                        context.translate(x * self.zoom, y * self.zoom)
-                        context.scale(self.zoom / MMTOPIXEL / z,
-                                      self.zoom / MMTOPIXEL / z)
-                        context.set_source_surface(image)
-                        context.paint()
-                        context.restore()
-                elif self.images_per_page == 4 and len(self.images) >= 4:
-                    for i in range(0, 4):
-                        image = create_image_surface_from_file(self.images[i])
-                        width = image.get_width() / MMTOPIXEL
-                        height = image.get_height() / MMTOPIXEL
-                        zw = width / (main_width / 2.0)
-                        zh = height / (main_height / 2.0)
-                        if zw > zh:
-                            z = zw
-                        else:
-                            z = zh
-                        x = float(i % 2) * main_width / 2.0 +\
-                            abs(width / z - main_width / 2.0) / 2.0
-                        y = float(i / 2) * main_height / 2.0 +\
-                            abs(height / z - main_height / 2.0) / 2.0
-                        context.save()
-                        context.translate(x * self.zoom, y * self.zoom)
-                        context.scale(self.zoom / MMTOPIXEL / z,
-                                      self.zoom / MMTOPIXEL / z)
-                        context.set_source_surface(image)
-                        context.paint()
-                        context.restore()
-                elif self.images_per_page == 6 and len(self.images) >= 6:
-                    for i in range(0, 6):
-                        image = create_image_surface_from_file(self.images[i])
-                        width = image.get_width() / MMTOPIXEL
-                        height = image.get_height() / MMTOPIXEL
-                        zw = width / (main_width / 3.0)
-                        zh = height / (main_height / 2.0)
-                        if zw > zh:
-                            z = zw
-                        else:
-                            z = zh
-                        x = float(i % 3) * main_width / 3.0 +\
-                            abs(width / z - main_width / 3.0) / 2.0
-                        y = float(i / 3) * main_height / 2.0 +\
-                            abs(height / z - main_height / 2.0) / 2.0
-                        context.save()
-                        context.translate(x * self.zoom, y * self.zoom)
-                        context.scale(self.zoom / MMTOPIXEL / z,
-                                      self.zoom / MMTOPIXEL / z)
-                        context.set_source_surface(image)
-                        context.paint()
-                        context.restore()
-                elif self.images_per_page == 8 and len(self.images) >= 8:
-                    for i in range(0, 8):
-                        image = create_image_surface_from_file(self.images[i])
-                        width = image.get_width() / MMTOPIXEL
-                        height = image.get_height() / MMTOPIXEL
-                        zw = width / (main_width / 4.0)
-                        zh = height / (main_height / 2.0)
-                        if zw > zh:
-                            z = zw
-                        else:
-                            z = zh
-                        x = float(i % 4) * main_width / 4.0 +\
-                            abs(width / z - main_width / 4.0) / 2.0
-                        y = float(i / 4) * main_height / 2.0 +\
-                            abs(height / z - main_height / 2.0) / 2.0
-                        context.save()
-                        context.translate(x * self.zoom, y * self.zoom)
-                        context.scale(self.zoom / MMTOPIXEL / z,
-                                      self.zoom / MMTOPIXEL / z)
-                        context.set_source_surface(image)
-                        context.paint()
-                        context.restore()
-
-
-
+            self.update_geometry()
+            if self.scale == 1.0:
+                image_surface = self.pages.get(self.page_number)
+                if image_surface is None:
+                    self.start_render()
         cr.save()
         cr.set_source_rgba(0.0, 0.0, 0.0, 0.5)
         cr.rectangle(self.margin_width - self.border,
@@ -276,9 +90,210 @@ class MiniView(Gtk.DrawingArea):
         cr.restore()
         #
         if self.page:
-            cr.set_source_surface(
-                self.image_surface, self.margin_width, self.margin_height)
-            cr.paint()
+            if self.scale != 1.0:
+                self.draw_tiles(cr)
+            elif image_surface is not None:
+                cr.set_source_surface(
+                    image_surface, self.margin_width, self.margin_height)
+                cr.paint()
+            else:
+                cr.save()
+                cr.set_source_rgba(1.0, 1.0, 1.0, 1.0)
+                cr.rectangle(self.margin_width, self.margin_height,
+                             self.page_width, self.page_height)
+                cr.fill()
+                cr.restore()
+
+    def update_geometry(self):
+        if self.orientation == LANDSCAPE:
+            zw = (self.width - 2.0 * self.margin) / self.or_width
+            zh = (self.height - 2.0 * self.margin) / self.or_height
+            if zw < zh:
+                self.zoom = zw
+            else:
+                self.zoom = zh
+            self.zoom *= self.scale
+            self.page_width = self.or_width * self.zoom
+            self.page_height = self.or_height * self.zoom
+            self.margin_width = (
+                self.width * self.scale - self.page_width) / 2.0
+            self.margin_height = (
+                self.height * self.scale - self.page_height) / 2.0
+        else:
+            zw = (self.width - 2.0 * self.margin) / self.or_height
+            zh = (self.height - 2.0 * self.margin) / self.or_width
+            if zw < zh:
+                self.zoom = zw
+            else:
+                self.zoom = zh
+            self.zoom *= self.scale
+            self.page_width = self.or_height * self.zoom
+            self.page_height = self.or_width * self.zoom
+            self.margin_width = (
+                self.width * self.scale - self.page_width) / 2.0
+            self.margin_height = (
+                self.height * self.scale - self.page_height) / 2.0
+
+    def get_main_size(self):
+        if self.orientation == LANDSCAPE:
+            return self.or_width, self.or_height
+        return self.or_height, self.or_width
+
+    def draw_tiles(self, cr):
+        """Paints the tiles of the zoomed page inside the clip and asks
+        for the ones that are not rendered yet"""
+        x1, y1, x2, y2 = cr.clip_extents()
+        x0 = int(self.margin_width)
+        y0 = int(self.margin_height)
+        width = int(math.ceil(self.page_width))
+        height = int(math.ceil(self.page_height))
+        first_column = max(0, int(x1 - x0) // TILE_SIZE)
+        last_column = min((width - 1) // TILE_SIZE, int(x2 - x0) // TILE_SIZE)
+        first_row = max(0, int(y1 - y0) // TILE_SIZE)
+        last_row = min((height - 1) // TILE_SIZE, int(y2 - y0) // TILE_SIZE)
+        wanted = []
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                x = column * TILE_SIZE
+                y = row * TILE_SIZE
+                tile_width = min(TILE_SIZE, width - x)
+                tile_height = min(TILE_SIZE, height - y)
+                key = (self.page_number, self.scale, column, row)
+                tile = self.tiles.get(key)
+                cr.save()
+                cr.rectangle(x0 + x, y0 + y, tile_width, tile_height)
+                if tile is not None:
+                    cr.set_source_surface(tile, x0 + x, y0 + y)
+                else:
+                    cr.set_source_rgba(1.0, 1.0, 1.0, 1.0)
+                    wanted.append((key, x, y, tile_width, tile_height))
+                cr.fill()
+                cr.restore()
+        self.start_tiles(wanted)
+
+    def start_tiles(self, wanted):
+        """Replaces the tiles waiting to be rendered with wanted, those
+        that scrolled out of view are forgotten"""
+        main_width, main_height = self.get_main_size()
+        with self.tiles_lock:
+            self.tiles_wanted = [
+                (self.generation, key, x, y, tile_width, tile_height,
+                 self.zoom, main_width, main_height, list(self.images),
+                 self.images_per_page)
+                for key, x, y, tile_width, tile_height in wanted
+                if key not in self.tiles_rendering]
+            if not self.tiles_wanted or self.tiles_worker:
+                return
+            self.tiles_worker = True
+        thread = threading.Thread(target=self.render_tiles)
+        thread.daemon = True
+        thread.start()
+
+    def render_tiles(self):
+        while True:
+            with self.tiles_lock:
+                if not self.tiles_wanted:
+                    self.tiles_worker = False
+                    return
+                job = self.tiles_wanted.pop(0)
+                self.tiles_rendering.add(job[1])
+            (generation, key, x, y, tile_width, tile_height, zoom,
+             main_width, main_height, images, images_per_page) = job
+            tile = compose_tile(
+                images, images_per_page, main_width, main_height, zoom, x,
+                y, tile_width, tile_height,
+                lambda: generation != self.generation, key[0])
+            GLib.idle_add(self.on_tile_finished, generation, key, tile)
+
+    def on_tile_finished(self, generation, key, tile):
+        with self.tiles_lock:
+            self.tiles_rendering.discard(key)
+        if generation == self.generation and tile is not None:
+            self.tiles.put(key, tile)
+            self.queue_draw()
+        return False
+
+    def set_scale(self, scale):
+        """Zooms the page, 1.0 fits it in the view"""
+        self.scale = max(1.0, min(scale, MAX_SCALE))
+        self.set_size_request(int(self.width * self.scale),
+                              int(self.height * self.scale))
+        self.queue_draw()
+
+    def get_actual_scale(self):
+        """Scale at which the page is shown at its printed size"""
+        return MMTOPIXEL * self.scale / self.zoom
+
+    def get_pages(self):
+        return max(1, int(math.ceil(float(len(self.images)) /
+                                    self.images_per_page)))
+
+    def start_render(self):
+        """Renders the current page, if needed, and then the pages next
+        to it, so they are ready when the user turns the page"""
+        pages = [page_number for page_number in
+                 (self.page_number, self.page_number + 1,
+                  self.page_number - 1)
+                 if 0 <= page_number < self.get_pages() and
+                 page_number not in self.rendering and
+                 page_number not in self.pages]
+        if not pages:
+            return
+        self.update_geometry()
+        self.rendering.update(pages)
+        thread = threading.Thread(
+            target=self.render,
+            args=(self.generation, pages, self.zoom, self.orientation,
+                  self.or_width, self.or_height, list(self.images),
+                  self.images_per_page))
+        thread.daemon = True
+        thread.start()
+
+    def render(self, generation, pages, zoom, orientation, or_width,
+               or_height, images, images_per_page):
+        if orientation == LANDSCAPE:
+            main_width = or_width
+            main_height = or_height
+        else:
+            main_width = or_height
+            main_height = or_width
+        for page_number in pages:
+            # give up when the settings change or the user went away
+            image_surface = compose_page(
+                images, images_per_page, main_width, main_height, zoom,
+                lambda: generation != self.generation or
+                abs(page_number - self.page_number) > 1,
+                page_number)
+            GLib.idle_add(self.on_render_finished, generation, page_number,
+                          image_surface)
+
+    def on_render_finished(self, generation, page_number, image_surface):
+        if generation == self.generation:
+            self.rendering.discard(page_number)
+            if image_surface is not None:
+                self.pages.put(page_number, image_surface)
+            if page_number == self.page_number:
+                self.queue_draw()
+        return False
+
+    def invalidate(self):
+        self.generation += 1
+        self.rendering.clear()
+        self.pages.clear()
+        self.tiles.clear()
+        with self.tiles_lock:
+            self.tiles_wanted = []
+        self.page_number = min(self.page_number, self.get_pages() - 1)
+        self.queue_draw()
+
+    def set_page_number(self, page_number):
+        """Shows page_number, 0 is the first page"""
+        page_number = max(0, min(page_number, self.get_pages() - 1))
+        if page_number != self.page_number:
+            self.page_number = page_number
+            if self.page and self.scale == 1.0:
+                self.start_render()
+            self.queue_draw()
 
     def set_page(self, page):
         self.page = page
@@ -287,23 +302,23 @@ class MiniView(Gtk.DrawingArea):
         self.or_width, self.or_height = self.page.get_size()
         self.or_width = int(self.or_width * RESOLUTION)
         self.or_height = int(self.or_height * RESOLUTION)
-        self.queue_draw()
+        self.invalidate()
 
     def set_orientation(self, orientation):
         self.orientation = orientation
-        self.queue_draw()
+        self.invalidate()
 
     def add_image(self, image):
         self.images.append(image)
-        self.queue_draw()
+        self.invalidate()
 
     def set_images(self, images):
         self.images = images
-        self.queue_draw()
+        self.invalidate()
 
     def set_images_per_page(self, images_per_page):
         self.images_per_page = images_per_page
-        self.queue_draw()
+        self.invalidate()
 
     def refresh(self):
         self.queue_draw()
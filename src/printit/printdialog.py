@@ -22,31 +22,24 @@
 #
 #
 from gi.repository import Gtk
-from gi.repository import GdkPixbuf
+from gi.repository import GLib
 from miniview import MiniView
 from PIL import Image
-import cairo
-import tempfile
-import shlex
-import subprocess
 import comun
-from comun import _, PORTRAIT, LANDSCAPE, MMTOPIXEL, MMTOPDF
+from comun import _, PORTRAIT, LANDSCAPE
 import cups
-import os
-from miniview import A0, A1, A2, A3, A4, A5, create_image_surface_from_file
+import threading
+from miniview import A0, A1, A2, A3, A4, A5
+from layout import GRIDS
+from renderer import parse_resolution
+from jobqueue import PrintJob
+from printers import list_printers, get_printer_capabilities,\
+    get_cached_capabilities, set_last_printer, PrinterCapabilities,\
+    get_chunk_pages, set_chunk_pages
 
 ADMISIBLE_PAPER_SIZES = ['A0', 'A1', 'A2', 'A3', 'A4', 'A5']
 
 
-def create_temp_file():
-    return tempfile.mkstemp(prefix='tmp_filemanager_printit_')[1]
-
-
-def list_printers():
-    con = cups.Connection()
-    return con.getPrinters()
-
-
 def select_index_in_combo(combo, index):
     combo.set_active(index)
 
@@ -65,49 +58,11 @@ def get_selected_value_in_combo(combo, index=0):
     return model.get_value(combo.get_active_iter(), index)
 
 
-def list_pagesize(aprinter):
-    args = shlex.split(
-        'lpoptions -d "%s" -l' %
-        (aprinter))
-    p = subprocess.Popen(
-        args, bufsize=10000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    ans = p.communicate()[0]
-    if p.returncode == 0:
-        print(ans)
-        if ans.find('PageSize/Page Size:') > -1:
-            start = ans.find('PageSize/Page Size:')
-            end = ans.find('\n', start)
-            ans = ans[start + len('PageSize/Page Size:'):end].split()
-            return ans
-        else:
-            raise ValueError('Not page sizes')
-            return []
-    raise ValueError(ans)
-    return []
-
-
-def list_resolution(aprinter):
-    args = shlex.split(
-        'lpoptions -d "%s" -l' %
-        (aprinter))
-    p = subprocess.Popen(
-        args, bufsize=10000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    ans = p.communicate()[0]
-    if p.returncode == 0:
-        if ans.find('Resolution/Output Resolution:') > -1:
-            start = ans.find('Resolution/Output Resolution:')
-            end = ans.find('\n', start)
-            ans = ans[start + len('Resolution/Output Resolution:'):end].split()
-            return ans
-        else:
-            raise ValueError('Not resolutions')
-            return []
-    raise ValueError(ans)
-    return []
-
-
 class PrintDialog(Gtk.Dialog):
-    def __init__(self, title, filenames=[]):
+    def __init__(self, title, filenames=[], num_threads=comun.NUM_THREADS,
+                 memory_budget=comun.MEMORY_BUDGET,
+                 oversampling=comun.OVERSAMPLING,
+                 chunk_pages=None, stages=None):
         Gtk.Dialog.__init__(self,
                             title,
                             None,
@@ -146,8 +101,6 @@ class PrintDialog(Gtk.Dialog):
         self.viewport1 = MiniView()
         self.scrolledwindow1.add(self.viewport1)
         #
-        self.scale = 100
-        #
         #
         label = Gtk.Label(_('Images per page'))
         label.set_alignment(0, 0.5)
@@ -155,11 +108,8 @@ class PrintDialog(Gtk.Dialog):
                      xoptions=Gtk.AttachOptions.FILL,
                      yoptions=Gtk.AttachOptions.SHRINK)
         listStore = Gtk.ListStore(str, int)
-        listStore.append(['1', 1])
-        listStore.append(['2', 2])
-        listStore.append(['4', 4])
-        listStore.append(['6', 6])
-        listStore.append(['8', 8])
+        for images_per_page in sorted(GRIDS.keys()):
+            listStore.append([str(images_per_page), images_per_page])
         self.images_per_page = Gtk.ComboBox()
         self.images_per_page.set_model(listStore)
         cell1 = Gtk.CellRendererText()
@@ -195,8 +145,6 @@ class PrintDialog(Gtk.Dialog):
                      xoptions=Gtk.AttachOptions.FILL,
                      yoptions=Gtk.AttachOptions.SHRINK)
         listStore = Gtk.ListStore(str)
-        for aprinter in list_printers():
-            listStore.append([aprinter])
         self.printers = Gtk.ComboBox()
         self.printers.set_model(listStore)
         cell1 = Gtk.CellRendererText()
@@ -221,7 +169,6 @@ class PrintDialog(Gtk.Dialog):
                      xoptions=Gtk.AttachOptions.FILL,
                      yoptions=Gtk.AttachOptions.SHRINK)
         self.papersizes.connect('changed', self.on_papersize_changed)
-        '''
         label = Gtk.Label(_('Resolution'))
         label.set_alignment(0, 0.5)
         table.attach(label, 0, 1, 5, 6,
@@ -236,10 +183,61 @@ class PrintDialog(Gtk.Dialog):
         table.attach(self.resolutions, 1, 2, 5, 6,
                      xoptions=Gtk.AttachOptions.FILL,
                      yoptions=Gtk.AttachOptions.SHRINK)
-        '''
+        label = Gtk.Label(_('Page'))
+        label.set_alignment(0, 0.5)
+        table.attach(label, 0, 1, 6, 7,
+                     xoptions=Gtk.AttachOptions.FILL,
+                     yoptions=Gtk.AttachOptions.SHRINK)
+        hbox = Gtk.HBox(spacing=5)
+        table.attach(hbox, 1, 2, 6, 7,
+                     xoptions=Gtk.AttachOptions.FILL,
+                     yoptions=Gtk.AttachOptions.SHRINK)
+        self.previous_page = Gtk.Button()
+        self.previous_page.set_image(Gtk.Image.new_from_stock(
+            Gtk.STOCK_GO_BACK, Gtk.IconSize.BUTTON))
+        self.previous_page.connect('clicked', self.on_previous_page_clicked)
+        hbox.pack_start(self.previous_page, False, False, 0)
+        self.page_number = Gtk.SpinButton()
+        self.page_number.set_adjustment(Gtk.Adjustment(1, 1, 1, 1, 10, 0))
+        self.page_number.set_numeric(True)
+        self.page_number.connect('value-changed',
+                                 self.on_page_number_changed)
+        hbox.pack_start(self.page_number, False, False, 0)
+        self.pages = Gtk.Label()
+        hbox.pack_start(self.pages, False, False, 0)
+        self.next_page = Gtk.Button()
+        self.next_page.set_image(Gtk.Image.new_from_stock(
+            Gtk.STOCK_GO_FORWARD, Gtk.IconSize.BUTTON))
+        self.next_page.connect('clicked', self.on_next_page_clicked)
+        hbox.pack_start(self.next_page, False, False, 0)
+        label = Gtk.Label(_('Pages per job'))
+        label.set_alignment(0, 0.5)
+        table.attach(label, 0, 1, 7, 8,
+                     xoptions=Gtk.AttachOptions.FILL,
+                     yoptions=Gtk.AttachOptions.SHRINK)
+        if chunk_pages is None:
+            chunk_pages = get_chunk_pages()
+        self.chunk_pages = Gtk.SpinButton()
+        self.chunk_pages.set_adjustment(
+            Gtk.Adjustment(chunk_pages, 0, 10000, 1, 10, 0))
+        self.chunk_pages.set_numeric(True)
+        self.chunk_pages.set_tooltip_text(
+            _('Long jobs are sent as separate jobs of this many pages, so '
+              'printing starts sooner. 0 sends a single job'))
+        table.attach(self.chunk_pages, 1, 2, 7, 8,
+                     xoptions=Gtk.AttachOptions.FILL,
+                     yoptions=Gtk.AttachOptions.SHRINK)
         #
         self.filenames = filenames
-        select_index_in_combo(self.printers, 0)
+        self.num_threads = num_threads
+        self.memory_budget = memory_budget
+        self.oversampling = oversampling
+        self.stages = stages
+        # printers and their options are filled in as cups answers
+        self.set_response_sensitive(Gtk.ResponseType.ACCEPT, False)
+        thread = threading.Thread(target=self.load_printers)
+        thread.daemon = True
+        thread.start()
         #
         if len(self.filenames) == 0:
             self.images_per_page.set_sensitive(False)
@@ -253,23 +251,38 @@ class PrintDialog(Gtk.Dialog):
     def draw_images(self):
         if self.filenames > 0:
             self.viewport1.set_images(self.filenames)
+        self.update_pages()
+
+    def update_pages(self):
+        pages = self.viewport1.get_pages()
+        self.page_number.set_range(1, pages)
+        self.page_number.set_value(self.viewport1.page_number + 1)
+        self.pages.set_text(_('of %s') % pages)
+        self.previous_page.set_sensitive(self.viewport1.page_number > 0)
+        self.next_page.set_sensitive(self.viewport1.page_number < pages - 1)
+
+    def on_page_number_changed(self, widget):
+        self.viewport1.set_page_number(self.page_number.get_value_as_int() - 1)
+        self.update_pages()
+
+    def on_previous_page_clicked(self, widget):
+        self.page_number.spin(Gtk.SpinType.STEP_BACKWARD, 1)
+
+    def on_next_page_clicked(self, widget):
+        self.page_number.spin(Gtk.SpinType.STEP_FORWARD, 1)
 
     def on_images_per_page_changed(self, widget):
         images_per_page = get_selected_value_in_combo(self.images_per_page, 1)
-        print('*************************************************')
-        print(images_per_page)
-        print('*************************************************')
-
         self.viewport1.set_images_per_page(images_per_page)
+        self.update_pages()
 
     def on_orientation_changed(self, widget):
         orientation = get_selected_value_in_combo(self.orientations, 1)
-        print('*************************************************')
-        print(orientation)
-        print('*************************************************')
         self.viewport1.set_orientation(orientation)
 
     def on_papersize_changed(self, widget):
+        if self.papersizes.get_active_iter() is None:
+            return
         apapersize = get_selected_value_in_combo(self.papersizes)
         if apapersize == 'A0':
             self.viewport1.set_page(A0)
@@ -284,11 +297,46 @@ class PrintDialog(Gtk.Dialog):
         elif apapersize == 'A5':
             self.viewport1.set_page(A5)
 
+    def load_printers(self):
+        try:
+            printers = list_printers()
+        except (cups.IPPError, RuntimeError):
+            printers = []
+        # only the selected printer is queried, the others when chosen
+        GLib.idle_add(self.on_printers_loaded, printers)
+
+    def on_printers_loaded(self, printers):
+        model = self.printers.get_model()
+        for aprinter in printers:
+            model.append([aprinter])
+        select_index_in_combo(self.printers, 0)
+        return False
+
+    def load_capabilities(self, aprinter):
+        try:
+            capabilities = get_printer_capabilities(aprinter, self.stages)
+        except Exception:
+            capabilities = PrinterCapabilities()
+        GLib.idle_add(self.on_capabilities_loaded, aprinter, capabilities)
+
     def on_printer_changed(self, widget):
+        self.set_response_sensitive(Gtk.ResponseType.ACCEPT, False)
         aprinter = get_selected_value_in_combo(self.printers)
+        capabilities = get_cached_capabilities(aprinter)
+        if capabilities is not None:
+            self.on_capabilities_loaded(aprinter, capabilities)
+        else:
+            thread = threading.Thread(target=self.load_capabilities,
+                                      args=(aprinter,))
+            thread.daemon = True
+            thread.start()
+
+    def on_capabilities_loaded(self, aprinter, capabilities):
+        if aprinter != self.get_printer():
+            return False
         model = self.papersizes.get_model()
         model.clear()
-        for apapersize in list_pagesize(aprinter):
+        for apapersize in capabilities.list_choices('PageSize'):
             if apapersize.startswith('*'):
                 apapersize = apapersize[1:]
             if apapersize in ADMISIBLE_PAPER_SIZES:
@@ -296,11 +344,17 @@ class PrintDialog(Gtk.Dialog):
         select_index_in_combo(self.papersizes, 0)
         model = self.resolutions.get_model()
         model.clear()
-        for aresolution in list_resolution(aprinter):
+        default = 0
+        for index, aresolution in enumerate(
+                capabilities.list_choices('Resolution')):
             if aresolution.startswith('*'):
                 aresolution = aresolution[1:]
+                default = index
             model.append([aresolution])
-        select_index_in_combo(self.resolutions, 0)
+        select_index_in_combo(self.resolutions, default)
+        self.set_response_sensitive(Gtk.ResponseType.ACCEPT,
+                                    len(self.papersizes.get_model()) > 0)
+        return False
 
     def get_images_per_page(self):
         return get_selected_value_in_combo(self.images_per_page, 1)
@@ -314,221 +368,71 @@ class PrintDialog(Gtk.Dialog):
     def get_papersize(self):
         return get_selected_value_in_combo(self.papersizes)
 
+    def get_resolution_choice(self):
+        if self.resolutions.get_active_iter() is None:
+            return None
+        return get_selected_value_in_combo(self.resolutions)
+
+    def get_resolution(self):
+        aresolution = self.get_resolution_choice()
+        if aresolution is None:
+            return -1
+        return parse_resolution(aresolution)
+
+    def get_chunk_pages(self):
+        return self.chunk_pages.get_value_as_int()
+
+    def get_job(self):
+        aprinter = self.get_printer()
+        set_last_printer(aprinter)
+        set_chunk_pages(self.get_chunk_pages())
+        return PrintJob(self.filenames, aprinter, self.get_papersize(),
+                        self.get_orientation(), self.get_images_per_page(),
+                        dpi=self.get_resolution(),
+                        oversampling=self.oversampling,
+                        num_threads=self.num_threads,
+                        memory_budget=self.memory_budget,
+                        chunk_pages=self.get_chunk_pages(),
+                        resolution=self.get_resolution_choice(),
+                        stages=self.stages)
+
     def pprint(self):
-        images_per_page = get_selected_value_in_combo(self.images_per_page, 1)
-        aprinter = get_selected_value_in_combo(self.printers)
-        orientation = get_selected_value_in_combo(self.orientations, 1)
-        apapersize = get_selected_value_in_combo(self.papersizes)
-        if apapersize == 'A0':
-            width, height = A0.get_size()
-        elif apapersize == 'A1':
-            width, height = A1.get_size()
-        elif apapersize == 'A2':
-            width, height = A2.get_size()
-        elif apapersize == 'A3':
-            width, height = A3.get_size()
-        elif apapersize == 'A4':
-            width, height = A4.get_size()
-        elif apapersize == 'A5':
-            width, height = A5.get_size()
-        if orientation == PORTRAIT:
-            twidth = height
-            height = width
-            width = twidth
-        temp_pdf = create_temp_file()
-        pdfsurface = cairo.PDFSurface(temp_pdf,
-                                      width / 25.4 * 72.0,
-                                      height / 25.4 * 72.0)
-        context = cairo.Context(pdfsurface)
-        if images_per_page == 1 and len(self.filenames) > 0:
-            for filename in self. filenames:
-                image1 = create_image_surface_from_file(filename)
-                w1 = image1.get_width() / MMTOPIXEL
-                h1 = image1.get_height() / MMTOPIXEL
-                zw = w1 / width
-                zh = h1 / height
-                if zw > zh:
-                    z = zw
-                else:
-                    z = zh
-                print(w1, h1)
-                context.save()
-                x = abs(w1 / z - width) / 2.0
-                y = abs(h1 / z - height) / 2.0
-                print(x, y)
-                context.translate(x * 2.8343, y * 2.8343)
-                context.scale(2.8343 / MMTOPIXEL / z, 2.8343 / MMTOPIXEL / z)
-                context.set_source_surface(image1)
-                context.paint()
-                context.restore()
-                context.show_page()
-        elif images_per_page == 2 and len(self.filenames) >= 2:
-            for contador in range(0, len(self. filenames), 2):
-                for i in range(0, 2):
-                    if(contador + i < len(self.filenames)):
-                        image = create_image_surface_from_file(
-                                self.filenames[contador + i])
-                        w = image.get_width() / MMTOPIXEL
-                        h = image.get_height() / MMTOPIXEL
-                        zw = w / (width / 2.0)
-                        zh = h / height
-                        if zw > zh:
-                            z = zw
-                        else:
-                            z = zh
-                        context.save()
-                        x = float(i) * width / 2.0 +\
-                            abs(w / z - width / 2.0) / 2.0
-                        y = abs(h / z - height) / 2.0
-                        context.translate(x * 2.8343, y * 2.8343)
-                        context.scale(2.8343 / MMTOPIXEL / z,
-                                      2.8343 / MMTOPIXEL / z)
-                        context.set_source_surface(image)
-                        context.paint()
-                        context.restore()
-                context.show_page()
-        elif images_per_page == 4 and len(self.filenames) >= 4:
-            for contador in range(0, len(self. filenames), 4):
-                for i in range(0, 4):
-                    if(contador + i < len(self.filenames)):
-                        image = create_image_surface_from_file(
-                            self.filenames[contador + i])
-                        w = image.get_width() / MMTOPIXEL
-                        h = image.get_height() / MMTOPIXEL
-                        zw = w / (width / 2.0)
-                        zh = h / (height / 2.0)
-                        if zw > zh:
-                            z = zw
-                        else:
-                            z = zh
-                        context.save()
-                        x = float(i % 2) * width / 2.0 +\
-                            abs(w / z - width / 2.0) / 2.0
-                        y = float(i / 2) * height / 2.0 +\
-                            abs(h / z - height / 2.0) / 2.0
-                        print(x, y)
-                        context.translate(x * 2.8343, y * 2.8343)
-                        context.scale(2.8343 / MMTOPIXEL / z,
-                                      2.8343 / MMTOPIXEL / z)
-                        context.set_source_surface(image)
-                        context.paint()
-                        context.restore()
-                context.show_page()
-        elif images_per_page == 6 and len(self.filenames) >= 6:
-            for contador in range(0, len(self. filenames), 6):
-                for i in range(0, 6):
-                    if(contador + i < len(self.filenames)):
-                        image = create_image_surface_from_file(
-                            self.filenames[contador + i])
-                        w = image.get_width() / MMTOPIXEL
-                        h = image.get_height() / MMTOPIXEL
-                        zw = w / (width / 3.0)
-                        zh = h / (height / 2.0)
-                        if zw > zh:
-                            z = zw
-                        else:
-                            z = zh
-                        context.save()
-                        x = float(i % 3) * width / 3.0 +\
-                            abs(w / z - width / 3.0) / 2.0
-                        y = float(i / 3) * height / 2.0 +\
-                            abs(h / z - height / 2.0) / 2.0
-                        context.translate(x * 2.8343, y * 2.8343)
-                        context.scale(2.8343 / MMTOPIXEL / z,
-                                      2.8343 / MMTOPIXEL / z)
-                        context.set_source_surface(image)
-                        context.paint()
-                        context.restore()
-                context.show_page()
-        elif images_per_page == 8 and len(self.filenames) >= 8:
-            for contador in range(0, len(self. filenames), 8):
-                for i in range(0, 8):
-                    if(contador + i < len(self.filenames)):
-                        image = create_image_surface_from_file(
-                            self.filenames[contador + i])
-                        w = image.get_width() / MMTOPIXEL
-                        h = image.get_height() / MMTOPIXEL
-                        zw = w / (width / 4.0)
-                        zh = h / (height / 2.0)
-                        if zw > zh:
-                            z = zw
-                        else:
-                            z = zh
-                        context.save()
-                        x = float(i % 4) * width / 4.0 +\
-                            abs(w / z - width / 4.0) / 2.0
-                        y = float(i / 4) * height / 2.0 +\
-                            abs(h / z - height / 2.0) / 2.0
-                        context.translate(x * 2.8343, y * 2.8343)
-                        context.scale(2.8343 / MMTOPIXEL / z,
-                                      2.8343 / MMTOPIXEL / z)
-                        context.set_source_surface(image)
-                        context.paint()
-                        context.restore()
-                context.show_page()
-        pdfsurface.flush()
-        pdfsurface.finish()
-        if orientation == LANDSCAPE:
-            printcommand = 'lp -d %s\
-                            -o media=%s\
-                            -o orientation-requested=4 "%s"' % (aprinter,
-                                                                apapersize,
-                                                                temp_pdf)
-        else:
-            printcommand = 'lp -d %s -o media=%s "%s"' % (aprinter,
-                                                          apapersize,
-                                                          temp_pdf)
-        print(printcommand)
-        args = shlex.split(printcommand)
-        p = subprocess.Popen(args, bufsize=10000, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-        ans = p.communicate()[0]
-        if p.returncode == 0:
-            print(ans)
-        os.remove(temp_pdf)
+        self.get_job().run()
 
     def on_key_release_event(self, widget, event):
-        print((event.keyval))
-        if event.keyval == 65451 or event.keyval == 43:
-            self.scale = self.scale * 1.1
+        if isinstance(self.get_focus(), Gtk.Editable):
+            # the keys belong to the entry, like the page number
+            return
+        if event.keyval == 65365:
+            self.on_previous_page_clicked(widget)
+        elif event.keyval == 65366:
+            self.on_next_page_clicked(widget)
+        elif event.keyval == 65451 or event.keyval == 43:
+            self.zoom(self.viewport1.scale * 1.25)
         elif event.keyval == 65453 or event.keyval == 45:
-            self.scale = self.scale * .9
+            self.zoom(self.viewport1.scale / 1.25)
         elif event.keyval == 65456 or event.keyval == 48:
-            pass
-            '''
-            factor_w = float(
-                self.scrolledwindow1.get_allocation().width) /\
-                float(self.pixbuf1.get_width())
-            factor_h = float(
-                self.scrolledwindow1.get_allocation().height) /\
-                float(self.pixbuf1.get_height())
-            if factor_w < factor_h:
-                factor = factor_w
-            else:
-                factor = factor_h
-            self.scale = int(factor * 100)
-            w = int(self.pixbuf1.get_width() * factor)
-            h = int(self.pixbuf1.get_height() * factor)
-            #
-            self.image1.set_from_pixbuf(
-                self.pixbuf1.scale_simple(w, h,
-                                          GdkPixbuf.InterpType.BILINEAR))
-            self.image2.set_from_pixbuf(
-                self.pixbuf2.scale_simple(w, h,
-                                          GdkPixbuf.InterpType.BILINEAR))
+            self.zoom(1.0)
         elif event.keyval == 65457 or event.keyval == 49:
-            self.scale = 100
-        if self.image1:
-            w = int(self.pixbuf1.get_width() * self.scale / 100)
-            h = int(self.pixbuf1.get_height() * self.scale / 100)
-            #
-            self.image1.set_from_pixbuf(
-                self.pixbuf1.scale_simple(w, h,
-                                          GdkPixbuf.InterpType.BILINEAR))
-            self.image2.set_from_pixbuf(
-                self.pixbuf2.scale_simple(w, h,
-                                          GdkPixbuf.InterpType.BILINEAR))
-            '''
+            if self.viewport1.page:
+                self.zoom(self.viewport1.get_actual_scale())
+
+    def zoom(self, scale):
+        """Zooms the preview keeping the centre of the view in place"""
+        adjustments = [self.scrolledwindow1.get_hadjustment(),
+                       self.scrolledwindow1.get_vadjustment()]
+        centers = [(adjustment.get_value() +
+                    adjustment.get_page_size() / 2.0) /
+                   max(adjustment.get_upper(), 1.0)
+                   for adjustment in adjustments]
+        self.viewport1.set_scale(scale)
+        GLib.idle_add(self.on_zoomed, adjustments, centers)
+
+    def on_zoomed(self, adjustments, centers):
+        for adjustment, center in zip(adjustments, centers):
+            adjustment.set_value(center * adjustment.get_upper() -
+                                 adjustment.get_page_size() / 2.0)
+        return False
 
     def close(self, widget):
         self.destroy()
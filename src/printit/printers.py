@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import json
+import time
+import threading
+import subprocess
+import collections
+import cups
+
+from comun import CAPABILITIES_TTL, CONFIG_DIR, CONFIG_FILE, LANDSCAPE,\
+    CHUNK_PAGES
+from metrics import METRICS
+
+CACHE = {}
+CACHE_LOCK = threading.Lock()
+# printer -> Event set when the capabilities being loaded are in CACHE
+LOADING = {}
+
+
+class PrinterCapabilities():
+    """Options of a printer as keyword -> choices plus their defaults"""
+
+    def __init__(self, options=None, defaults=None, modtime=0):
+        if options is None:
+            options = collections.OrderedDict()
+        if defaults is None:
+            defaults = {}
+        self.options = options
+        self.defaults = defaults
+        self.modtime = modtime
+        self.timestamp = time.time()
+
+    def is_expired(self):
+        return time.time() - self.timestamp > CAPABILITIES_TTL
+
+    def get_choices(self, keyword):
+        return self.options.get(keyword, [])
+
+    def get_default(self, keyword):
+        return self.defaults.get(keyword)
+
+    def list_choices(self, keyword):
+        """Choices with the default one marked with '*', like lpoptions"""
+        default = self.get_default(keyword)
+        return ['*' + choice if choice == default else choice
+                for choice in self.get_choices(keyword)]
+
+
+def read_ppd(filename):
+    ppd = cups.PPD(filename)
+    options = collections.OrderedDict()
+    defaults = {}
+    for group in ppd.optionGroups:
+        for option in group.options:
+            options[option.keyword] = [choice['choice']
+                                       for choice in option.choices]
+            defaults[option.keyword] = option.defchoice
+    return options, defaults
+
+
+def read_lpoptions(aprinter):
+    p = subprocess.Popen(['lpoptions', '-p', aprinter, '-l'],
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    ans = p.communicate()[0].decode('utf-8', 'replace')
+    if p.returncode != 0:
+        raise ValueError(ans)
+    options = collections.OrderedDict()
+    defaults = {}
+    for line in ans.splitlines():
+        if line.find(':') == -1:
+            continue
+        name, choices = line.split(':', 1)
+        keyword = name.split('/', 1)[0].strip()
+        options[keyword] = []
+        for choice in choices.split():
+            if choice.startswith('*'):
+                choice = choice[1:]
+                defaults[keyword] = choice
+            options[keyword].append(choice)
+    return options, defaults
+
+
+def load_printer_capabilities(aprinter, cached=None):
+    """Reads the capabilities of aprinter from its PPD in a single IPP
+    request. When the printer has no PPD falls back to lpoptions"""
+    con = cups.Connection()
+    modtime = 0
+    if cached is not None:
+        modtime = cached.modtime
+    filename = None
+    try:
+        if hasattr(con, 'getPPD3'):
+            status, modtime, filename = con.getPPD3(aprinter, modtime)
+            if status == cups.HTTP_NOT_MODIFIED and cached is not None:
+                cached.timestamp = time.time()
+                return cached
+        else:
+            filename = con.getPPD(aprinter)
+        options, defaults = read_ppd(filename)
+    except (cups.IPPError, RuntimeError):
+        options, defaults = read_lpoptions(aprinter)
+    finally:
+        if filename and os.path.isfile(filename):
+            os.remove(filename)
+    return PrinterCapabilities(options, defaults, modtime)
+
+
+def read_config():
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def set_config_value(key, value):
+    config = read_config()
+    if config.get(key) == value:
+        return
+    config[key] = value
+    try:
+        if not os.path.exists(CONFIG_DIR):
+            os.makedirs(CONFIG_DIR)
+        with open(CONFIG_FILE, 'w') as f:
+            json.dump(config, f)
+    except (IOError, OSError):
+        pass
+
+
+def get_last_printer():
+    return read_config().get('last_printer')
+
+
+def set_last_printer(aprinter):
+    set_config_value('last_printer', aprinter)
+
+
+def get_chunk_pages():
+    """Pages per cups job, 0 sends every job as a single one"""
+    try:
+        return max(0, int(read_config().get('chunk_pages', CHUNK_PAGES)))
+    except (TypeError, ValueError):
+        return CHUNK_PAGES
+
+
+def set_chunk_pages(chunk_pages):
+    set_config_value('chunk_pages', chunk_pages)
+
+
+def list_printers():
+    """Printer names, the last used one first and then the default one"""
+    con = cups.Connection()
+    printers = con.getPrinters()
+    last = get_last_printer()
+    default = con.getDefault()
+    return sorted(printers.keys(),
+                  key=lambda aprinter: (aprinter != last,
+                                        aprinter != default,
+                                        aprinter))
+
+
+def get_cached_capabilities(aprinter):
+    with CACHE_LOCK:
+        cached = CACHE.get(aprinter)
+    if cached is not None and not cached.is_expired():
+        return cached
+    return None
+
+
+def get_printer_capabilities(aprinter, stages=None):
+    """Capabilities of aprinter, from the cache while they are fresh. The
+    time spent asking cups is added to stages, a metrics.Stages.
+    Concurrent callers for the same printer share a single query"""
+    with CACHE_LOCK:
+        cached = CACHE.get(aprinter)
+        if cached is not None and not cached.is_expired():
+            return cached
+        loading = LOADING.get(aprinter)
+        owner = loading is None
+        if owner:
+            loading = LOADING[aprinter] = threading.Event()
+    if not owner:
+        loading.wait()
+        with CACHE_LOCK:
+            capabilities = CACHE.get(aprinter)
+        if capabilities is None:
+            # the query failed, try again for this caller
+            return get_printer_capabilities(aprinter, stages)
+        return capabilities
+    try:
+        start = time.time()
+        capabilities = load_printer_capabilities(aprinter, cached)
+        if stages is not None:
+            stages.add_stage('printer_query', time.time() - start)
+        with CACHE_LOCK:
+            CACHE[aprinter] = capabilities
+    finally:
+        with CACHE_LOCK:
+            del LOADING[aprinter]
+        loading.set()
+    return capabilities
+
+
+def list_pagesize(aprinter):
+    return get_printer_capabilities(aprinter).list_choices('PageSize')
+
+
+def list_resolution(aprinter):
+    return get_printer_capabilities(aprinter).list_choices('Resolution')
+
+
+def get_print_options(papersize, orientation, resolution=None):
+    options = {'media': papersize}
+    if orientation == LANDSCAPE:
+        options['orientation-requested'] = '4'
+    if resolution:
+        options['Resolution'] = resolution
+    return options
+
+
+class CupsDocument():
+    """File object that writes straight into a document of a CUPS job, so
+    the PDF is sent while it is being rendered"""
+
+    def __init__(self, con, aprinter, job_id, name, last_document=True):
+        self.con = con
+        self.printer = aprinter
+        status = con.startDocument(aprinter, job_id, name, 'application/pdf',
+                                   int(last_document))
+        if status != cups.HTTP_CONTINUE:
+            raise IOError('Can not start document %s (%s)' % (name, status))
+
+    def write(self, data):
+        with METRICS.stage('spool'):
+            status = self.con.writeRequestData(data, len(data))
+        METRICS.count('spooled_bytes', len(data))
+        if status != cups.HTTP_CONTINUE:
+            raise IOError('Can not send data to %s (%s)' % (self.printer,
+                                                           status))
+
+    def close(self):
+        self.con.finishDocument(self.printer)
+
+
+def print_stream(aprinter, title, options, render):
+    """Creates a job on aprinter and calls render with a file object that
+    streams into it. The job is cancelled if render fails"""
+    with METRICS.stage('spool'):
+        con = cups.Connection()
+        job_id = con.createJob(aprinter, title, options)
+    try:
+        with METRICS.stage('spool'):
+            document = CupsDocument(con, aprinter, job_id, title)
+        render(document)
+        with METRICS.stage('spool'):
+            document.close()
+    except Exception:
+        con.cancelJob(job_id)
+        raise
+    return job_id
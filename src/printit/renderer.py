@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import math
+import collections
+import cairo
+
+from comun import MMTOPT, NUM_THREADS, MEMORY_BUDGET, OVERSAMPLING
+from decoder import DecodePipeline
+from imagecache import get_streamed_surface, get_image_surface,\
+    get_preview_surface, get_pyramid_surface, probe_images, deduplicate,\
+    set_unique_id, get_surface_size
+from layout import Layout, get_grid, paint_image
+from metrics import METRICS
+
+
+def parse_resolution(aresolution):
+    """Returns the larger dpi of a ppd resolution like 600dpi or
+    1200x600dpi, or -1 when it can not be parsed"""
+    try:
+        return max(int(value) for value in
+                   aresolution.lower().replace('dpi', '').split('x'))
+    except ValueError:
+        return -1
+
+
+def get_print_size(width, height, dpi):
+    """Size in pixels of a width x height mm cell printed at dpi, or
+    -1, -1 (full size) when the resolution is unknown"""
+    if dpi <= 0:
+        return -1, -1
+    return (int(math.ceil(width / 25.4 * dpi)),
+            int(math.ceil(height / 25.4 * dpi)))
+
+
+def get_preview_size(zoom, width, height):
+    return (int(math.ceil(width * zoom)), int(math.ceil(height * zoom)))
+
+
+def compose_page(images, images_per_page, width, height, zoom,
+                 cancelled=None, page=0):
+    """Preview of page (0 is the first) of images on a width x height mm
+    page at zoom pixels per mm. Returns None when cancelled() becomes
+    True"""
+    image_surface = cairo.ImageSurface(
+        cairo.FORMAT_RGB24,
+        int(width * zoom),
+        int(height * zoom))
+    context = cairo.Context(image_surface)
+    context.set_source_rgba(1.0, 1.0, 1.0, 1.0)
+    context.paint()
+    layout = Layout(width, height, *get_grid(images_per_page))
+    preview_size = get_preview_size(zoom, layout.cell_width,
+                                    layout.cell_height)
+    images = images[page * images_per_page:(page + 1) * images_per_page]
+    placements = layout.place(probe_images(images))
+    context.scale(zoom, zoom)
+    for index, filename in enumerate(images):
+        if cancelled is not None and cancelled():
+            return None
+        image = get_preview_surface(filename, *preview_size)
+        paint_image(context, image, *placements[index])
+    return image_surface
+
+
+def compose_tile(images, images_per_page, width, height, zoom, x, y,
+                 tile_width, tile_height, cancelled=None, page=0):
+    """The tile_width x tile_height pixels at x, y of the page preview
+    compose_page would make at zoom, painting only the images that
+    overlap it, each from the nearest level of its pyramid"""
+    image_surface = cairo.ImageSurface(cairo.FORMAT_RGB24, tile_width,
+                                       tile_height)
+    context = cairo.Context(image_surface)
+    context.set_source_rgba(1.0, 1.0, 1.0, 1.0)
+    context.paint()
+    layout = Layout(width, height, *get_grid(images_per_page))
+    images = images[page * images_per_page:(page + 1) * images_per_page]
+    placements = layout.place(probe_images(images))
+    context.translate(-x, -y)
+    context.scale(zoom, zoom)
+    for index, filename in enumerate(images):
+        if cancelled is not None and cancelled():
+            return None
+        image_x, image_y, image_width, image_height = placements[index]
+        if image_x * zoom >= x + tile_width or\
+                (image_x + image_width) * zoom <= x or\
+                image_y * zoom >= y + tile_height or\
+                (image_y + image_height) * zoom <= y:
+            continue
+        image = get_pyramid_surface(
+            filename, *get_preview_size(zoom, image_width, image_height))
+        paint_image(context, image, *placements[index])
+    return image_surface
+
+
+def render_pdf(filenames, output, width, height, images_per_page, dpi=-1,
+               oversampling=OVERSAMPLING, num_threads=NUM_THREADS,
+               memory_budget=MEMORY_BUDGET):
+    """Writes filenames, images_per_page on each width x height mm page,
+    as a PDF to output (a filename or a file object). Images are
+    downsampled to dpi * oversampling when dpi is known. Repeated images
+    are decoded once, while they fit in half the memory budget, and
+    embedded once.
+
+    With a memory_budget images are streamed: surfaces already in the
+    image cache are used, but new ones are not added to it, so a print
+    warms the cache for nothing and a second print of the same images
+    decodes them again. Without a budget everything goes through the
+    cache, with no bound on the memory a job takes"""
+    pdfsurface = cairo.PDFSurface(output,
+                                  width * MMTOPT,
+                                  height * MMTOPT)
+    context = cairo.Context(pdfsurface)
+    context.scale(MMTOPT, MMTOPT)
+    if memory_budget > 0:
+        # streaming: nothing outlives its page, not even in the cache
+        decode = get_streamed_surface
+    else:
+        decode = get_image_surface
+    with METRICS.stage('layout'):
+        layout = Layout(width, height, *get_grid(images_per_page))
+        # only headers are read here, images are decoded when painted
+        placements = layout.place(probe_images(filenames))
+        images, indexes = deduplicate(filenames)
+    METRICS.count('duplicates', len(filenames) - len(images))
+    cell_width, cell_height = get_print_size(
+        layout.cell_width, layout.cell_height, dpi * oversampling)
+
+    def loader(filename):
+        with METRICS.stage('decode'):
+            image = decode(filename, cell_width, cell_height)
+        METRICS.count('decoded_pixels',
+                      image.get_width() * image.get_height())
+        return set_unique_id(image, filename)
+
+    pipeline = DecodePipeline(images, loader,
+                              num_threads=num_threads,
+                              memory_budget=memory_budget)
+    decoded = iter(pipeline)
+    uses = collections.Counter(indexes)
+    # images that are used again later, with their budget still taken
+    shared = {}
+    shared_size = 0
+    released = []
+    last = len(filenames) - 1
+    for index, image_index in enumerate(indexes):
+        uses[image_index] -= 1
+        if image_index in shared:
+            image = shared[image_index]
+            if uses[image_index] == 0:
+                del shared[image_index]
+                shared_size -= get_surface_size(image)
+                released.append(image_index)
+        elif image_index == pipeline.consumed:
+            image = next(decoded)
+            size = get_surface_size(image)
+            if uses[image_index] > 0 and (
+                    memory_budget <= 0 or
+                    shared_size + size <= memory_budget // 2):
+                shared[image_index] = image
+                shared_size += size
+            else:
+                released.append(image_index)
+        else:
+            # it did not fit in the budget to be kept
+            image = loader(images[image_index])
+        with METRICS.stage('paint'):
+            paint_image(context, image, *placements[index])
+            image = None
+            if layout.is_last_in_page(index) or index == last:
+                context.show_page()
+                pipeline.release(released)
+                released = []
+                METRICS.count('pages')
+    pipeline.close()
+    with METRICS.stage('pdf_finish'):
+        pdfsurface.flush()
+        pdfsurface.finish()
+    METRICS.count('images', len(filenames))
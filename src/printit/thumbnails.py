@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-printi
+#
+# Copyright (C) 2016 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import hashlib
+import threading
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+from comun import PREVIEW_CACHE_DIR, PREVIEW_CACHE_SIZE
+
+THUMBNAILS_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'), 'thumbnails')
+# freedesktop thumbnail folders and the largest side of their thumbnails
+THUMBNAIL_SIZES = [('normal', 128), ('large', 256), ('x-large', 512),
+                   ('xx-large', 1024)]
+URI_KEY = 'tEXt::Thumb::URI'
+MTIME_KEY = 'tEXt::Thumb::MTime'
+
+
+def get_uri(filename):
+    return GLib.filename_to_uri(os.path.abspath(filename), None)
+
+
+def get_thumbnail_name(uri):
+    return hashlib.md5(uri.encode('utf-8')).hexdigest()
+
+
+def read_thumbnail(filename, uri, mtime):
+    """Loads a thumbnail png, or returns None when it does not exist or
+    was made for another file or another version of it"""
+    try:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
+    except GLib.Error:
+        return None
+    if pixbuf.get_option(URI_KEY) != uri or\
+            pixbuf.get_option(MTIME_KEY) != str(int(mtime)):
+        return None
+    return pixbuf
+
+
+def has_same_shape(pixbuf, image_width, image_height):
+    """True when pixbuf has the aspect ratio of the image, give or take
+    the rounding of its sides. Thumbnailers apply the EXIF orientation,
+    so the thumbnail of a rotated photo is not the image we paint"""
+    return abs(pixbuf.get_width() * image_height -
+               pixbuf.get_height() * image_width) <=\
+        image_width + image_height
+
+
+def is_big_enough(pixbuf, width, height, image_width, image_height):
+    """True when pixbuf has at least the pixels of the image scaled to
+    fit in width x height (images are never scaled up)"""
+    scale = min(float(width) / image_width, float(height) / image_height,
+                1.0)
+    return pixbuf.get_width() >= int(image_width * scale) - 1 and\
+        pixbuf.get_height() >= int(image_height * scale) - 1
+
+
+class PreviewStore():
+    """Previews written by us, as freedesktop style png thumbnails, in a
+    folder that is trimmed to max_size bytes, least recently used
+    first"""
+
+    def __init__(self, folder=PREVIEW_CACHE_DIR,
+                 max_size=PREVIEW_CACHE_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def get_filename(self, uri, width, height):
+        return os.path.join(self.folder, '%s-%sx%s.png' % (
+            get_thumbnail_name(uri), width, height))
+
+    def get(self, uri, mtime, width, height):
+        filename = self.get_filename(uri, width, height)
+        pixbuf = read_thumbnail(filename, uri, mtime)
+        if pixbuf is not None:
+            try:
+                # the modification time orders the eviction
+                os.utime(filename, None)
+            except OSError:
+                pass
+        return pixbuf
+
+    def put(self, uri, mtime, width, height, pixbuf):
+        filename = self.get_filename(uri, width, height)
+        temporal = '%s.%s' % (filename, threading.current_thread().ident)
+        try:
+            # private like the images they come from, as the freedesktop
+            # thumbnail spec asks
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder, 0o700)
+            os.close(os.open(temporal, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o600))
+            pixbuf.savev(temporal, 'png', [URI_KEY, MTIME_KEY],
+                         [uri, str(int(mtime))])
+            os.rename(temporal, filename)
+            self.added(os.path.getsize(filename))
+        except (GLib.Error, OSError):
+            if os.path.exists(temporal):
+                os.remove(temporal)
+
+    def get_entries(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            filename = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def added(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry[1] for entry in self.get_entries())
+            else:
+                self.size += size
+            if self.size <= self.max_size:
+                return
+            # trim to 3/4 of the budget so it is not done on every put
+            for mtime, size, filename in sorted(self.get_entries()):
+                if self.size <= self.max_size * 3 // 4:
+                    break
+                try:
+                    os.remove(filename)
+                    self.size -= size
+                except OSError:
+                    pass
+
+
+def load_preview_pixbuf(filename, width, height, image_width, image_height):
+    """Returns filename scaled to fit in width x height, from the
+    freedesktop thumbnails when one is big enough, from our previews, or
+    decoded and then saved to our previews"""
+    uri = get_uri(filename)
+    mtime = os.path.getmtime(filename)
+    name = get_thumbnail_name(uri) + '.png'
+    for folder, size in THUMBNAIL_SIZES:
+        if size < max(width, height) and\
+                size < max(image_width, image_height):
+            continue
+        pixbuf = read_thumbnail(os.path.join(THUMBNAILS_DIR, folder, name),
+                                uri, mtime)
+        if pixbuf is not None and\
+                has_same_shape(pixbuf, image_width, image_height) and\
+                is_big_enough(pixbuf, width, height, image_width,
+                              image_height):
+            return pixbuf
+    pixbuf = PREVIEWS.get(uri, mtime, width, height)
+    if pixbuf is not None:
+        return pixbuf
+    if image_width <= width and image_height <= height:
+        # small images are not worth a copy
+        return GdkPixbuf.Pixbuf.new_from_file(filename)
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, width, height)
+    PREVIEWS.put(uri, mtime, width, height, pixbuf)
+    return pixbuf
+
+PREVIEWS = PreviewStore()